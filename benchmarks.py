@@ -0,0 +1,298 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from outsourcer import Code, CodeBuilder, Val, _new_module, sym
+
+# Each workload builds a module that looks like the output of a real generator,
+# and then exercises the generated code. The suite times each phase on its own:
+#   build:   creating the CodeBuilder and its tree of fragments
+#   render:  source_code()
+#   compile: compiling the source text, as compile() does
+#   exec:    executing the compiled module
+#   run:     calling the generated functions
+
+
+def workload_deep_if_elif(b, size=500):
+    with b.DEF('classify', ['x']):
+        for i in range(size):
+            with b.IF(sym.x == i) if i == 0 else b.ELIF(sym.x == i):
+                b.RETURN(f'case{i}')
+        with b.ELSE():
+            b.RETURN(None)
+
+    return lambda module: [module.classify(x) for x in range(0, size + 1, 7)]
+
+
+def workload_many_defs(b, size=3000):
+    _build_large_module(b, size)
+    b += sym.errors << []
+
+    def run(module):
+        for i in range(size):
+            getattr(module, f'rule{i}')('0abc', i % 2)
+
+    return run
+
+
+def workload_huge_literals(b, size=50_000):
+    b += sym.numbers << Val(list(range(size)))
+    b += sym.table << Val({f'key{i}': (i, str(i), i / 2) for i in range(size // 5)})
+    with b.DEF('lookup', ['key']):
+        b.RETURN(sym.table.get(sym.key))
+
+    return lambda module: [module.lookup(f'key{i}') for i in range(0, size // 5, 3)]
+
+
+def workload_operator_chain(b, size=1000):
+    with b.DEF('total', ['x']):
+        expr = sym.x
+        for i in range(size):
+            expr = expr + (sym.x if i % 2 else i)
+        b.RETURN(expr)
+
+    return lambda module: [module.total(x) for x in range(200)]
+
+
+def workload_heavy_var(b, size=5000):
+    with b.DEF('accumulate', ['x']):
+        previous = b.var('tmp', sym.x)
+        for i in range(size):
+            previous = b.var('tmp', previous + i)
+        b.RETURN(previous)
+
+    return lambda module: [module.accumulate(x) for x in range(20)]
+
+
+WORKLOADS = {
+    'deep_if_elif': workload_deep_if_elif,
+    'many_defs': workload_many_defs,
+    'huge_literals': workload_huge_literals,
+    'operator_chain': workload_operator_chain,
+    'heavy_var': workload_heavy_var,
+}
+
+
+def run_workload(workload, repeat=5):
+    timings = {phase: [] for phase in ['build', 'render', 'compile', 'exec', 'run']}
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        b = CodeBuilder()
+        run = workload(b)
+        timings['build'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        b.source_code()
+        timings['render'].append(time.perf_counter() - start)
+
+        # Time compile() in two parts, since it also executes the module.
+        source_code = b.source_code(minimal_parens=True)
+        start = time.perf_counter()
+        code_object = compile(source_code, '<bench>', 'exec', optimize=2)
+        timings['compile'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        module = _new_module('bench', None, [code_object], None, None)
+        timings['exec'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        run(module)
+        timings['run'].append(time.perf_counter() - start)
+
+    return {
+        phase: {'min': min(values), 'median': statistics.median(values)}
+        for phase, values in timings.items()
+    }
+
+
+def run_suite(names=None, repeat=5):
+    results = {}
+    for name in names or WORKLOADS:
+        results[name] = run_workload(WORKLOADS[name], repeat)
+        phases = ', '.join(
+            f'{phase} {stats["min"] * 1000:.1f}'
+            for phase, stats in results[name].items()
+        )
+        print(f'{name:16} {phases} (ms)')
+
+    return {
+        'metadata': {
+            'commit': _current_commit(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'timestamp': datetime.datetime.now().astimezone().isoformat(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current):
+    # Show each phase's best time as a ratio of the baseline's best time, so that
+    # values above 1 are slower than before.
+    print(f'compared to {baseline["metadata"].get("commit") or "baseline"}:')
+    for name, phases in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        ratios = ', '.join(
+            f'{phase} {stats["min"] / previous[phase]["min"]:.2f}x'
+            for phase, stats in phases.items()
+            if phase in previous
+        )
+        print(f'{name:16} {ratios}')
+
+
+def _current_commit():
+    try:
+        output = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def _build_large_module(b, num_functions=2000):
+    for i in range(num_functions):
+        with b.DEF(f'rule{i}', ['text', 'pos']):
+            result = b.var('result', None)
+            with b.IF(sym.text[sym.pos] == str(i % 10)):
+                b += result << (sym.pos + 1, 'digit')
+            with b.ELIF(sym.text.startswith('abc', sym.pos)):
+                b += result << (sym.pos + 3, sym.text[sym.pos : sym.pos + 3])
+            with b.ELSE():
+                b += sym.errors.append((sym.pos, i))
+            b.RETURN(result)
+
+
+def _best_of(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_ast_mode():
+    # Time the first compile of a new builder each time. Compiling the same
+    # builder again would mostly time the text mode's render cache.
+    def first_compile(use_ast):
+        best = None
+        for _ in range(5):
+            b = CodeBuilder(use_ast=use_ast)
+            _build_large_module(b)
+            elapsed = _best_of(b.compile, repeat=1)
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    text_time = first_compile(False)
+    ast_time = first_compile(True)
+    print('ast mode, compile() of 2000 generated functions:')
+    print(f'    text: {text_time * 1000:8.1f} ms')
+    print(f'    ast:  {ast_time * 1000:8.1f} ms ({text_time / ast_time:.2f}x)')
+
+
+def bench_deep_render():
+    for size in [100_000, 300_000]:
+        expr = sym.x0
+        for i in range(1, size):
+            expr = expr + Code(f'x{i}')
+
+        elapsed = _best_of(lambda expr=expr: repr(expr))
+        per_node = elapsed / size * 1e9
+        print(f'render a chain of {size} additions: {elapsed * 1000:8.1f} ms', end='')
+        print(f' ({per_node:.0f} ns per node)')
+
+
+def bench_repeated_render():
+    b = CodeBuilder()
+    _build_large_module(b)
+
+    start = time.perf_counter()
+    b.source_code()
+    first = time.perf_counter() - start
+    again = _best_of(b.source_code)
+
+    print('source_code() of 2000 generated functions:')
+    print(f'    first call: {first * 1000:8.1f} ms')
+    print(f'    next calls: {again * 1000:8.1f} ms ({first / again:.1f}x)')
+
+
+def bench_node_memory(num_rules=2000):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    b = CodeBuilder()
+    _build_large_module(b, num_rules)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    num_nodes = _count_nodes(b._root)
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f'memory for {num_nodes} nodes: {total / 1024 / 1024:6.1f} MB', end='')
+    print(f' ({total / num_nodes:.0f} bytes per node)')
+
+
+def _count_nodes(statements):
+    # Count every occurrence, so that shared nodes are counted once per use.
+    count = 0
+    stack = list(statements)
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Code):
+            count += 1
+            stack.extend(item._parts)
+        elif hasattr(item, '_statements'):
+            stack.extend(item._statements)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the outsourcer benchmarks.')
+    parser.add_argument('workloads', nargs='*', help=', '.join(WORKLOADS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='where to save the results as JSON')
+    parser.add_argument('--compare', help='a JSON file of earlier results')
+    parser.add_argument('--micro', action='store_true', help='run micro benchmarks too')
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f'unknown workload: {name}')
+
+    report = run_suite(args.workloads, args.repeat)
+
+    output = args.output
+    if output is None:
+        name = report['metadata']['commit'] or 'unknown'
+        output = os.path.join('bench-results', f'{name}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'saved results to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+    if args.micro:
+        bench_ast_mode()
+        bench_deep_render()
+        bench_repeated_render()
+        bench_node_memory()
+
+
+if __name__ == '__main__':
+    main()
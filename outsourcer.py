@@ -1,25 +1,133 @@
-from collections import defaultdict
-from contextlib import contextmanager
-import io
+from collections import ChainMap, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext, suppress
+import __future__
+import ast
+import bisect
+import builtins
+import functools
+import gc
+import hashlib
+import importlib.util
+import json
+import keyword
+import marshal
+import math
+import operator
+import os
+import sys
+import tempfile
 import textwrap
+import threading
+import time
+import tracemalloc
 import types
+import weakref
 
 
 __version__ = '0.0.1'
 
-__all__ = ['CodeBuilder', 'Code', 'Val', 'Yield', 'sym']
+__all__ = [
+    'BuildStats',
+    'CodeBuilder',
+    'Code',
+    'DiskCache',
+    'MemoryCache',
+    'Val',
+    'Yield',
+    'combine_increments',
+    'compile_many',
+    'load_profile',
+    'merge_literal_appends',
+    'read_profile',
+    'reset_profile',
+    'save_profile',
+    'structure_key',
+    'sym',
+]
 
 OMITTED = object()
 
 
 class CodeBuilder:
-    def __init__(self, max_num_blocks=20):
+    def __init__(
+        self,
+        max_num_blocks=20,
+        use_ast=False,
+        render_cache_limit=1024,
+        hash_cons=False,
+        outline=False,
+        max_function_statements=None,
+        fold_constants=False,
+        stats=False,
+        profile=False,
+        profile_branches=False,
+        branch_profile=None,
+        hoist_loop_invariants=False,
+        scoped_names=False,
+        eliminate_dead_code=False,
+        peephole=False,
+        record_call_sites=False,
+    ):
         self.state = {}
         self._root = []
         self._statements = self._root
         self._num_blocks = 1
         self._max_num_blocks = max_num_blocks
         self._names = defaultdict(int)
+        self._local_names = defaultdict(int)
+        self._scoped_names = scoped_names
+        self._eliminate_dead_code = eliminate_dead_code
+        self._allocated = set()
+
+        # The peephole argument can be a list of rules. See merge_literal_appends
+        # for an example. The default rules leave out combine_increments, which
+        # is only safe when the targets hold ints.
+        if peephole is True:
+            peephole = [merge_literal_appends]
+        self._peephole_rules = list(peephole) if peephole else None
+        self._fusable = {}
+
+        # Map the id of each statement to the statement and to the place in the
+        # generator that appended it.
+        self._call_sites = {} if record_call_sites else None
+
+        # A fork numbers its variables with a prefix of its own, and keeps its
+        # top-level statements apart from its global section.
+        self._name_prefix = ''
+        self._num_forks = 0
+        self._open_forks = set()
+        self._fork_key = None
+        self._body = self._root
+        self._use_ast = use_ast
+        self._stream = None
+        self._render_cache_limit = render_cache_limit
+        self._consed = {} if hash_cons else None
+        self._root_hoisted = ChainMap()
+        self._hoisted = self._root_hoisted
+        self._outline = outline or max_function_statements is not None
+        self._max_function_statements = max_function_statements
+        self._root_scope = _Scope('module')
+        self._scope = self._root_scope
+        self._outline_temps = set()
+        self._fold_constants = fold_constants
+
+        # The stats argument can be a callback, which receives the stats after
+        # each compile.
+        self.stats = BuildStats() if stats else None
+        self._stats_callback = stats if callable(stats) else None
+        self._profile = profile or profile_branches
+        self._profile_branches = profile_branches
+        self._has_profile_table = False
+
+        # With a branch profile, reorderable if and elif clauses are sorted
+        # by how often they were taken.
+        if isinstance(branch_profile, (str, os.PathLike)):
+            branch_profile = load_profile(branch_profile)
+        self._branch_profile = branch_profile
+        self._reorderable = {}
+        self._hoist_loop_invariants = hoist_loop_invariants
+        self._hoisted_globals = []
 
     def current_num_blocks(self):
         return self._num_blocks
@@ -30,40 +138,502 @@ class CodeBuilder:
     def __lshift__(self, statement):
         self.append(statement)
 
-    def source_code(self):
-        writer = _Writer()
-        for statement in self._statements:
-            writer.write_line(statement)
-        return writer.getvalue()
+    def source_code(self, minimal_parens=False):
+        with self._measure('render'):
+            if self._use_ast:
+                result = ast.unparse(self.syntax_tree()) + '\n'
+            else:
+                writer = _Writer(self._render_cache_limit, minimal_parens)
+                for statement in self._prepared(self._statements):
+                    writer.write_line(statement)
+                result = writer.getvalue()
+
+        if self.stats is not None:
+            self.stats._record_output(self._statements, result)
+        return result
 
-    def compile(self, module_name='code', docstring=None, source_var=None):
-        source_code = self.source_code()
-        code_object = compile(source_code, f'<{module_name}>', 'exec', optimize=2)
-        module = types.ModuleType(module_name, doc=docstring)
-        exec(code_object, module.__dict__)
+    def _measure(self, phase):
+        return nullcontext() if self.stats is None else self.stats.measure(phase)
+
+    def _report_stats(self):
+        if self._stats_callback is not None:
+            self._stats_callback(self.stats)
+
+    def _prepared(self, statements):
+        # Run the optional passes that rewrite the statements before output.
+        if self._hoisted_globals:
+            self._undo_stale_hoists(statements)
+        if self._peephole_rules is not None:
+            fusable = dict(self._fusable)
+            statements = _peephole_block(statements, self._peephole_rules, fusable)
+        if self._fold_constants:
+            statements = _fold_block(statements, {})
+        if self._eliminate_dead_code:
+            # When streaming, the rest of an if statement may not be here yet.
+            complete = self._stream is None
+            statements = _prune_block(statements, self._allocated, complete)
+        return statements
+
+    def iter_source(self, chunk_size=64 * 1024):
+        if self._use_ast:
+            source_code = self.source_code()
+            for start in range(0, len(source_code), chunk_size):
+                yield source_code[start : start + chunk_size]
+            return
+
+        writer = _Writer(self._render_cache_limit)
+        pending, pending_size = [], 0
+        for statement in self._prepared(self._statements):
+            writer.write_line(statement)
+            text = writer.take()
+            pending.append(text)
+            pending_size += len(text)
+            if pending_size >= chunk_size:
+                yield ''.join(pending)
+                pending, pending_size = [], 0
+        if pending:
+            yield ''.join(pending)
+
+    def write_to(self, fp, chunk_size=64 * 1024):
+        for chunk in self.iter_source(chunk_size):
+            fp.write(chunk)
+
+    def stream_to(self, fp):
+        if self._use_ast:
+            raise ValueError('Cannot stream a builder that uses the ast mode')
+
+        # From now on, every finished top-level statement goes straight to fp.
+        self._stream = fp
+        self.flush()
+
+    def flush(self):
+        if self._stream is None or not self._root:
+            return
+
+        writer = _Writer(self._render_cache_limit)
+        for statement in self._prepared(self._root):
+            writer.write_line(statement)
+        self._stream.write(writer.getvalue())
+
+        # Clear the list in place, since self._statements may refer to it.
+        self._root.clear()
+
+    def syntax_tree(self):
+        # Lowering allocates a large, acyclic tree, which mostly just gives the
+        # cyclic garbage collector a lot of pointless work to do. The tree uses
+        # one node for all the loads of each name and for each constant, so
+        # copy it before changing it in place. Trees don't share them, though.
+        with _gc_paused(), _shared_nodes():
+            body = _lower_block(self._prepared(self._statements))
+        return ast.Module(body=body, type_ignores=[])
+
+    def compile(
+        self,
+        module_name='code',
+        docstring=None,
+        source_var=None,
+        cache=None,
+        minimal_parens=True,
+        lazy=False,
+    ):
+        if self._stream is not None:
+            raise ValueError('Cannot compile a builder that streams its output')
+
+        if lazy:
+            return self._compile_lazy(
+                module_name, docstring, source_var, cache, minimal_parens
+            )
+
+        if self._use_ast:
+            # Hand the tree straight to compile(), skipping the text round trip.
+            with _gc_paused():
+                with self._measure('render'):
+                    tree = self.syntax_tree()
+                with self._measure('compile'):
+                    code_object = _compile_source(tree, module_name, cache)
+            source_code = None if source_var is None else ast.unparse(tree) + '\n'
+            if self.stats is not None:
+                self.stats._record_output(self._statements, source_code)
+        else:
+            source_code = self.source_code(minimal_parens)
+            with self._measure('compile'):
+                code_object = _compile_source(source_code, module_name, cache)
+
+        with self._measure('exec'):
+            module = _new_module(
+                module_name, docstring, [code_object], source_var, source_code
+            )
+        self._report_stats()
+        return module
 
-        # Optionally assign the source code to a variable in the module.
-        if source_var is not None:
-            setattr(module, source_var, source_code)
+    def compile_sharded(
+        self,
+        module_name='code',
+        docstring=None,
+        source_var=None,
+        cache=None,
+        num_shards=None,
+        executor=None,
+        minimal_parens=True,
+    ):
+        if self._stream is not None:
+            raise ValueError('Cannot compile a builder that streams its output')
+
+        # Each shard is padded with blank lines, so that the line numbers in
+        # its code objects match the line numbers of a serial compile. The
+        # __future__ imports are in the first shard, so the others get their
+        # flags from the compiler.
+        shards, line_number = [], 0
+        num_shards = num_shards or os.cpu_count() or 1
+        with self._measure('render'):
+            texts = self._shard_source(num_shards, minimal_parens)
+        flags = _future_flags(texts[0]) if texts else 0
+        for text in texts:
+            shards.append(('\n' * line_number + text, module_name, flags))
+            line_number += text.count('\n')
+
+        with self._measure('compile'):
+            code_objects = _compile_all(shards, cache, executor)
+        if source_var is None:
+            source_code = None
+        else:
+            source_code = ''.join(texts)
+        if self.stats is not None:
+            self.stats._record_output(self._statements, ''.join(texts))
+
+        with self._measure('exec'):
+            module = _new_module(
+                module_name, docstring, code_objects, source_var, source_code
+            )
+        self._report_stats()
+        return module
 
+    def _compile_lazy(self, module_name, docstring, source_var, cache, minimal_parens):
+        writer = _Writer(self._render_cache_limit, minimal_parens)
+
+        # Replace each top-level function with a stub, padded with blank lines so
+        # that the rest of the module keeps its line numbers. The real function
+        # is compiled the first time that its stub is called.
+        texts, eager, functions = [], [], []
+        line_number = 0
+        decorated = False
+        with self._measure('render'):
+            statements = self._prepared(self._statements)
+            index = 0
+            while index < len(statements):
+                statement = statements[index]
+                index += 1
+                is_def = (
+                    isinstance(statement, Code)
+                    and statement._kind == 'def'
+                    and not decorated
+                    and index < len(statements)
+                    and isinstance(statements[index], _Block)
+                )
+                writer.write_line(statement)
+                if is_def:
+                    writer.write_line(statements[index])
+                    index += 1
+                text = writer.take()
+                texts.append(text)
+
+                num_lines = text.count('\n')
+                if is_def:
+                    name = statement._parts[1]
+                    functions.append((name, '\n' * line_number + text))
+                    stub = f'{name} = _outsourcer_lazy({len(functions) - 1})\n'
+                    eager.append(stub + '\n' * (num_lines - 1))
+                else:
+                    eager.append(text)
+                    if not _is_trivia(statement):
+                        decorated = text.lstrip().startswith('@')
+                line_number += num_lines
+
+        source_code = ''.join(texts)
+        if self.stats is not None:
+            self.stats._record_output(self._statements, source_code)
+        eager_source = ''.join(eager)
+        with self._measure('compile'):
+            code_object = _compile_source(eager_source, module_name, cache)
+
+        # The functions are compiled on their own, so they need the flags of
+        # the module's __future__ imports.
+        flags = _future_flags(eager_source)
+        with self._measure('exec'):
+            module = types.ModuleType(module_name, doc=docstring)
+            namespace = module.__dict__
+            namespace['_outsourcer_lazy'] = functools.partial(
+                _lazy_function, namespace, functions, module_name, cache, flags
+            )
+            try:
+                _run_code(code_object, namespace)
+            finally:
+                namespace.pop('_outsourcer_lazy', None)
+            if source_var is not None:
+                setattr(module, source_var, source_code)
+        self._report_stats()
         return module
 
+    def compile_template(self, name, holes, module_name='code', cache=None):
+        # Compile the top-level function `name` once, inside a factory whose
+        # parameters are the holes, and return the factory. The function reads
+        # each hole as a closure variable, so calling the factory with values
+        # for the holes makes a new function without compiling anything. The
+        # rest of the module runs once, and becomes the functions' globals.
+        if self._stream is not None:
+            raise ValueError('Cannot compile a builder that streams its output')
+
+        writer = _Writer(self._render_cache_limit, minimal_parens=True)
+        statements = self._prepared(self._statements)
+        module_texts, function_text, line_number = [], None, 1
+        index = 0
+        while index < len(statements):
+            statement = statements[index]
+            index += 1
+            if (
+                isinstance(statement, Code)
+                and statement._kind == 'def'
+                and statement._parts[1] == name
+                and index < len(statements)
+                and isinstance(statements[index], _Block)
+            ):
+                # Indent the function, so that it can go inside the factory.
+                writer._indent = 1
+                writer.write_line(statement)
+                writer.write_line(statements[index])
+                writer._indent = 0
+                index += 1
+                function_text, function_line = writer.take(), line_number
+                text = '\n' * function_text.count('\n')
+            else:
+                writer.write_line(statement)
+                text = writer.take()
+            module_texts.append(text)
+            line_number += text.count('\n')
+
+        if function_text is None:
+            raise ValueError(f'No top-level function named {name}')
+
+        # Move the factory up, so that the function keeps its line numbers. When
+        # the function is on the first line, the factory ends up on line 0.
+        params = ', '.join(holes)
+        tree = ast.parse(
+            f'def _outsourcer_template({params}):\n{function_text}    return {name}\n'
+        )
+        ast.increment_lineno(tree, function_line - 2)
+        module_source = ''.join(module_texts)
+        flags = _future_flags(module_source)
+        code_objects = [
+            _compile_source(module_source, module_name, cache),
+            _compile_source(tree, module_name, cache, flags),
+        ]
+        module = _new_module(module_name, None, code_objects, None, None)
+        factory = module.__dict__.pop('_outsourcer_template')
+        factory.__name__ = factory.__qualname__ = f'{name}_template'
+        return factory
+
+    def write_module(
+        self,
+        path,
+        docstring=None,
+        split=False,
+        check_source=True,
+        optimize=0,
+        minimal_parens=True,
+    ):
+        if self._stream is not None:
+            raise ValueError('Cannot write a builder that streams its output')
+
+        # With split=False, path names a single .py file. Otherwise path names
+        # a package directory, with each top-level def and class in a file of
+        # its own. The package's __init__.py loads each file's code object,
+        # from its .pyc file, and runs it in the package's namespace.
+        path = os.fspath(path)
+        header = '' if docstring is None else f'{docstring!r}\n'
+        with self._measure('render'):
+            units = self._top_level_units(minimal_parens)
+
+        if not split:
+            files = {path: header + ''.join(text for _, text in units)}
+        else:
+            # The __future__ imports must come first, so they go ahead of the
+            # loader, and each file gets a copy of them.
+            files, lines, names = {}, [header], set()
+            futures = []
+            while units and (_is_trivia(units[0][0]) or _is_future_import(units[0][1])):
+                if not _is_trivia(units[0][0]):
+                    futures.append(units[0][1])
+                lines.append(units.pop(0)[1])
+            lines.append(_PACKAGE_LOADER)
+            for head, text in units:
+                if not isinstance(head, Code) or head._kind not in ('def', 'class'):
+                    lines.append(text)
+                    continue
+                name = f'_{head._parts[1]}'
+                while name.lower() in names:
+                    name += '_'
+                names.add(name.lower())
+                files[os.path.join(path, f'{name}.py')] = ''.join([*futures, text])
+                lines.append(f'_outsourcer_load({name!r})\n')
+            lines.append('del _find_spec, _outsourcer_load\n')
+            files[os.path.join(path, '__init__.py')] = ''.join(lines)
+            os.makedirs(path, exist_ok=True)
+
+        with self._measure('compile'):
+            for filename, source_code in files.items():
+                _write_source(filename, source_code, check_source, optimize)
+        self._report_stats()
+        return path
+
+    def _shard_source(self, num_shards, minimal_parens=False):
+        texts = [text for _, text in self._top_level_units(minimal_parens)]
+        target = sum(map(len, texts)) / num_shards
+        shards, current, current_size = [], [], 0
+        for text in texts:
+            current.append(text)
+            current_size += len(text)
+            if current_size >= target and len(shards) < num_shards - 1:
+                shards.append(''.join(current))
+                current, current_size = [], 0
+        if current:
+            shards.append(''.join(current))
+        return shards
+
+    def _top_level_units(self, minimal_parens=False):
+        writer = _Writer(self._render_cache_limit, minimal_parens)
+
+        # Group the top-level statements into units that can be compiled on
+        # their own. A block stays with its header, a def or class stays with
+        # its decorators, and elif, else, except and finally blocks stay with
+        # the statement that they continue, along with any blank lines and
+        # comments in between. Each unit is a pair of its first statement and
+        # its text. For a decorated def or class, the pair has the def or class
+        # instead of its first decorator.
+        units = []
+        last_solid = -1
+        decorated = False
+        for statement in self._prepared(self._statements):
+            writer.write_line(statement)
+            text = writer.take()
+
+            if _is_trivia(statement):
+                units.append([statement, text])
+                continue
+
+            if last_solid >= 0 and (decorated or _continues_statement(statement)):
+                merged = units[last_solid]
+                for unit in units[last_solid + 1 :]:
+                    merged.extend(unit[1:])
+                del units[last_solid + 1 :]
+                merged.append(text)
+                if decorated:
+                    merged[0] = statement
+            else:
+                units.append([statement, text])
+                last_solid = len(units) - 1
+            if not isinstance(statement, _Block):
+                decorated = text.lstrip().startswith('@')
+
+        return [(unit[0], ''.join(unit[1:])) for unit in units]
+
     def append(self, statement):
         if statement and isinstance(statement, str):
             statement = Code(statement)
 
+        if self._consed is not None and isinstance(statement, Code):
+            statement = self._hash_cons(statement)
+
+        if self._outline:
+            self._record_bindings(statement)
+
+        if self._call_sites is not None:
+            self._record_call_site(statement)
+
         self._statements.append(statement)
+        if self._stream is not None and self._statements is self._root:
+            self.flush()
         return self
 
     def extend(self, statements):
+        if self._consed is not None:
+            statements = [
+                self._hash_cons(x) if isinstance(x, Code) else x for x in statements
+            ]
+
+        if self._outline:
+            for statement in statements:
+                self._record_bindings(statement)
+
+        if self._call_sites is not None:
+            for statement in statements:
+                self._record_call_site(statement)
+
         self._statements.extend(statements)
+        if self._stream is not None and self._statements is self._root:
+            self.flush()
         return self
 
     def append_global(self, statement):
         if isinstance(statement, str):
             statement = Code(statement)
 
+        if self._consed is not None:
+            statement = self._hash_cons(statement)
+
+        if self._call_sites is not None:
+            self._record_call_site(statement)
+
         self._root.append(statement)
+        if self._stream is not None:
+            self.flush()
+
+    def _record_call_site(self, statement):
+        # A shared statement keeps the first place that appended it.
+        if isinstance(statement, Code) and id(statement) not in self._call_sites:
+            self._call_sites[id(statement)] = (statement, _call_site())
+
+    def line_map(self):
+        # Map the first line of each statement in the source code to the place
+        # in the generator that appended it, as a (filename, line) pair.
+        return {line: site for line, site in self._line_sites() if site is not None}
+
+    def attribute_samples(self, samples, module_name='code'):
+        # Total a profiler's samples from the generated module by the places in
+        # the generator that appended the statements. Each sample is a pair of
+        # a filename and a line number, with an optional weight. A pstats.Stats
+        # object also works, using the time spent in each function.
+        if hasattr(samples, 'stats'):
+            samples = [(*key[:2], value[2]) for key, value in samples.stats.items()]
+
+        line_sites = self._line_sites()
+        lines = [line for line, _ in line_sites]
+        filename = f'<{module_name}>'
+        result = defaultdict(int)
+        for sample in samples:
+            if sample[0] != filename:
+                continue
+            index = bisect.bisect_right(lines, sample[1]) - 1
+            site = line_sites[index][1] if index >= 0 else None
+            if site is not None:
+                result[site] += sample[2] if len(sample) > 2 else 1
+        return dict(result)
+
+    def _line_sites(self):
+        if self._call_sites is None:
+            raise ValueError('Call sites are only recorded with record_call_sites')
+        if self._use_ast:
+            raise ValueError('Line maps are not available in ast mode')
+        if self._stream is not None:
+            raise ValueError('Line maps are not available when streaming')
+
+        writer = _Writer(self._render_cache_limit, line_map=True)
+        for statement in self._prepared(self._statements):
+            writer.write_line(statement)
+        sites = self._call_sites
+        return [
+            (line, sites[id(statement)][1] if id(statement) in sites else None)
+            for line, statement in writer.line_starts()
+        ]
 
     def has_available_blocks(self, num_blocks=1):
         return self._num_blocks + num_blocks <= self._max_num_blocks
@@ -74,13 +644,104 @@ class CodeBuilder:
             self.append(result << initializer)
         return result
 
+    def hoist(self, expr, base_name='tmp'):
+        # The caller promises that expr is pure, and that its operands don't
+        # change in the current block, so one temporary can serve every use.
+        expr = Val(expr)
+        key = structure_key(expr)
+        result = self._hoisted.get(key)
+        if result is None:
+            result = self._hoisted[key] = self.var(base_name, expr)
+        return result
+
+    def _hash_cons(self, statement):
+        # Rebuild the tree bottom up, so that structurally identical fragments
+        # become the same object. Children are keyed by the id of their shared
+        # instance, which the table keeps alive.
+        table = self._consed
+        shared = {}
+        stack = [statement]
+        while stack:
+            node = stack[-1]
+            if id(node) in shared:
+                stack.pop()
+                continue
+
+            pending = [
+                part
+                for part in node._parts
+                if isinstance(part, Code) and id(part) not in shared
+            ]
+            if pending:
+                stack.extend(pending)
+                continue
+
+            stack.pop()
+            parts = tuple(
+                shared[id(part)] if isinstance(part, Code) else part
+                for part in node._parts
+            )
+            key = (node._kind, *(_part_key(part) for part in parts))
+            try:
+                result = table.get(key)
+            except TypeError:
+                # Some part isn't hashable, so leave this fragment alone.
+                shared[id(node)] = node
+                continue
+
+            if result is None:
+                if any(a is not b for a, b in zip(parts, node._parts)):
+                    result = _node(node._kind, *parts)
+                else:
+                    result = node
+                table[key] = result
+            shared[id(node)] = result
+
+        return shared[id(statement)]
+
+    def release(self, name):
+        # Let a later var() in the same function reuse a temporary that the
+        # generated code no longer reads. Without scoped names, this does
+        # nothing.
+        scope = self._scope
+        if not self._scoped_names or scope.kind != 'function':
+            return
+
+        text = name._parts[0] if isinstance(name, Code) else name
+        base_name = scope.temporaries.get(text)
+        if base_name is None:
+            raise ValueError(f'Not a variable of the current function: {text}')
+        released = scope.released.setdefault(base_name, [])
+        if text in released:
+            raise ValueError(f'Variable already released: {text}')
+        released.append(text)
+
     def _reserve_name(self, base_name):
-        self._names[base_name] += 1
-        return Code(f'{base_name}{self._names[base_name]}')
+        # With scoped names, each function numbers its variables on its own,
+        # skipping the numbers of the module's variables. A nested function
+        # continues from its parent, so that it doesn't hide the variables
+        # that it closes over.
+        scope = self._scope
+        if self._scoped_names and scope.kind == 'function':
+            released = scope.released.get(base_name)
+            if released:
+                return _node('name', released.pop())
+            number = max(scope.counters[base_name], self._names[base_name]) + 1
+            scope.counters[base_name] = number
+            self._local_names[base_name] = max(self._local_names[base_name], number)
+            name = f'{base_name}{self._name_prefix}{number}'
+            scope.temporaries[name] = base_name
+        else:
+            number = max(self._names[base_name], self._local_names[base_name]) + 1
+            self._names[base_name] = number
+            name = f'{base_name}{self._name_prefix}{number}'
+
+        self._allocated.add(name)
+        return _node('name', name)
 
     def add_comment(self, content):
         for line in content.split('\n'):
-            self.append(Code('# ', line))
+            self.append(_node('comment', '# ', line))
 
     def add_docstring(self, content):
         safe = content.replace('\\', '\\\\').replace('"""', '\\"\\"\\"')
@@ -93,51 +754,260 @@ class CodeBuilder:
 
     @contextmanager
     def CLASS(self, name, superclass=None):
-        with self._new_block() as block:
+        with self._new_block() as block, self._new_scope('class', name=name):
             yield
         extra = f'({superclass})' if superclass else ''
-        self.append(Code('class ', name, extra, ':'))
+        self.append(_node('class', 'class ', name, extra, ':'))
         self.append(_Block(block))
         self.add_newline()
 
     @contextmanager
     def DEF(self, name, params):
-        with self._new_block() as block:
-            yield
-        self.append(Code('def ', name, '(', ', '.join(params), '):'))
+        with self._new_block() as block, self._new_scope('function', params, name):
+            if self._profile:
+                # The body goes inside a try statement, to time every exit.
+                label = self._scope.label()
+                self._num_blocks += 1
+            try:
+                yield
+            finally:
+                if self._profile:
+                    self._num_blocks -= 1
+
+            if self._outline:
+                self._finish_outlines(self._scope, block)
+            if self._hoist_loop_invariants:
+                block = self._hoist_invariants(params, block)
+
+        if self._profile:
+            block = self._profiled_body(label, block)
+        self.append(_node('def', 'def ', name, '(', ', '.join(params), '):'))
         self.append(_Block(block))
         self.add_newline()
 
+    def _hoist_invariants(self, params, statements):
+        # Find the names that the function never binds, which are globals or
+        # builtins, so that its loops can read them from locals instead.
+        writer = _Writer(self._render_cache_limit)
+        for statement in statements:
+            writer.write_line(statement)
+        try:
+            bound = _bound_names(ast.parse(writer.getvalue()))[0]
+        except SyntaxError:
+            return statements
+        for param in params:
+            bound.add(param.lstrip('*').partition('=')[0].partition(':')[0].strip())
+        hoisted = set()
+        result = self._hoist_block(statements, bound, hoisted)
+        if hoisted:
+            # Since the function's list becomes the list of its _Block, the
+            # hoisting can be undone in place if the globals turn out to change.
+            self._hoisted_globals.append((result, statements, hoisted))
+        return result
+
+    def _undo_stale_hoists(self, statements):
+        # A loop reads its hoisted globals once before it starts, so it misses
+        # the changes that other code makes to them. Undo the hoisting in the
+        # functions that read a global that the module assigns or that some
+        # function declares global.
+        writer = _Writer(self._render_cache_limit)
+        for statement in statements:
+            writer.write_line(statement)
+        try:
+            rebound = _rebound_globals(ast.parse(writer.getvalue()))
+        except SyntaxError:
+            rebound = None
+
+        remaining = []
+        for entry in self._hoisted_globals:
+            result, original, hoisted = entry
+            if rebound is None or not hoisted.isdisjoint(rebound):
+                result[:] = original
+            else:
+                remaining.append(entry)
+        self._hoisted_globals = remaining
+
+    def _hoist_block(self, statements, bound, hoisted):
+        result = []
+        index = 0
+        while index < len(statements):
+            statement = statements[index]
+            index += 1
+            block = statements[index] if index < len(statements) else None
+            if not isinstance(statement, Code) or not isinstance(block, _Block):
+                result.append(statement)
+                continue
+
+            index += 1
+            keyword = statement._parts[0] if statement._kind == 'header' else None
+            if keyword == 'for' or keyword == 'while':
+                result.extend(self._hoist_loop(statement, block, bound, hoisted))
+            elif statement._kind in ('def', 'class'):
+                result.extend([statement, block])
+            else:
+                result.append(statement)
+                body = self._hoist_block(block._statements, bound, hoisted)
+                result.append(_Block(body))
+        return result
+
+    def _hoist_loop(self, header, block, bound, hoisted):
+        # Bind the loop's invariant globals and method lookups, like `len` and
+        # `out.append`, to locals before the loop starts. A method lookup is
+        # invariant when the loop doesn't rebind its base name or assign an
+        # attribute with the method's name. Longer chains like `a.b.append`
+        # stay, since a call in the loop could rebind `a.b`. Add the globals
+        # that the locals depend on to hoisted.
+        writer = _Writer(self._render_cache_limit)
+        writer.write_line(header)
+        writer.write_line(block)
+        try:
+            loop_names, loop_attributes = _bound_names(ast.parse(writer.getvalue()))
+        except SyntaxError:
+            return [header, block]
+
+        # Only hoist the names and method lookups that every iteration makes,
+        # since a lookup in a branch may depend on the branch's condition, and
+        # the loop may not run at all.
+        targets, callees = {}, set()
+        stack = [(x, True) for x in reversed(block._statements)]
+        if header._parts[0] == 'while':
+            stack.append((header._parts[2], True))
+        while stack:
+            node, always = stack.pop()
+            if isinstance(node, _Block):
+                stack.extend((x, False) for x in reversed(node._statements))
+                continue
+            if not isinstance(node, Code) or node._kind in ('def', 'class'):
+                continue
+
+            if node._kind == 'call' and always:
+                callees.add(id(node._parts[0]))
+                chain = _attribute_chain(node._parts[0]) or ()
+                if (
+                    len(chain) == 2
+                    and chain[0] not in loop_names
+                    and chain[1] not in loop_attributes
+                ):
+                    targets.setdefault(repr(node._parts[0]), []).append(
+                        (node._parts[0], chain[-1])
+                    )
+                    stack.extend((x, always) for x in reversed(node._parts[1:]))
+                    continue
+            elif node._kind == 'name':
+                name = node._parts[0]
+                is_global = name not in bound and not keyword.iskeyword(name)
+                if always and is_global and name.isidentifier():
+                    targets.setdefault(name, []).append((node, name))
+                continue
+            elif node._kind == 'binop' and node._parts[2] in (' and ', ' or '):
+                stack.append((node._parts[3], False))
+                stack.append((node._parts[1], always))
+                continue
+            stack.extend((x, always) for x in reversed(node._parts))
+
+        result, replacements = [], {}
+        for uses in targets.values():
+            node, base_name = uses[0]
+            # Only a call can fall back to making the lookup again.
+            only_calls = all(id(x) in callees for x, _ in uses)
+            if not only_calls and not _is_builtin_lookup(node, bound):
+                continue
+            base = node if node._kind == 'name' else node._parts[0]
+            if base._parts[0] not in bound:
+                hoisted.add(base._parts[0])
+            local = self.var(base_name)
+            result.extend(self._hoisted_binding(local, node, bound))
+            for node, _ in uses:
+                replacements[id(node)] = local
+
+        if not result:
+            return [header, block]
+
+        memo = {}
+        if header._parts[0] == 'while':
+            header = _replace_nodes(header, replacements, memo)
+        result.append(header)
+        result.append(_Block(_replace_in_block(block._statements, replacements, memo)))
+        return result
+
+    def _hoisted_binding(self, local, node, bound):
+        # The loop may not run at all, so the lookup can only fail when the
+        # loop uses it. A builtin and its attributes can't fail. Otherwise, if
+        # the lookup fails, the local makes the lookup again each time it's
+        # called, which raises the same error.
+        if _is_builtin_lookup(node, bound):
+            return [local << node]
+        args, kwargs = repr(self.var('args')), repr(self.var('kwargs'))
+        fallback = f'lambda *{args}, **{kwargs}: {node!r}(*{args}, **{kwargs})'
+        return [
+            _node('header', 'try', ':'),
+            _Block([local << node]),
+            _node('header', 'except', ' ', Code('Exception'), ':'),
+            _Block([local << Code(fallback)]),
+        ]
+
+    def _profiled_body(self, label, statements):
+        self._add_profile_table()
+        key = repr(label)
+        elapsed = '_profile_clock() - _profile_start'
+        return [
+            Code(f'_profile_counts[{key}] += 1'),
+            Code('_profile_start = _profile_clock()'),
+            _node('header', 'try', ':'),
+            _Block(statements),
+            _node('header', 'finally', ':'),
+            _Block([Code(f'_profile_times[{key}] += {elapsed}')]),
+        ]
+
+    def _add_profile_table(self):
+        if self._has_profile_table:
+            return
+        self._has_profile_table = True
+        with self.global_section():
+            self.append('from collections import Counter as _ProfileCounter')
+            self.append('from time import perf_counter as _profile_clock')
+            self.add_newline()
+            self.append('_profile_counts = _ProfileCounter()')
+            self.append('_profile_times = _ProfileCounter()')
+            self.add_newline()
+
     def WHILE(self, condition):
         return self._control_block('while', condition)
 
-    def IF(self, condition):
+    # A reorderable condition has no side effects, and it can't be true at the
+    # same time as any other reorderable condition next to it in the chain.
+
+    # With the peephole pass, an if statement marked with fuse=True merges into
+    # the next one, when that one is also marked and has the same condition.
+    # This is only safe when the first body can't change the condition.
+
+    def IF(self, condition, reorderable=False, fuse=False):
         if isinstance(condition, str):
             condition = Code(condition)
 
-        return self._control_block('if', condition)
+        return self._control_block('if', condition, reorderable, fuse)
 
-    def IF_NOT(self, condition):
+    def IF_NOT(self, condition, reorderable=False, fuse=False):
         if isinstance(condition, str):
             condition = Code(condition)
 
-        return self.IF(Code('not (', Val(condition), ')'))
+        return self.IF(_node('not', 'not (', Val(condition), ')'), reorderable, fuse)
 
-    def ELIF(self, condition):
+    def ELIF(self, condition, reorderable=False):
         if isinstance(condition, str):
             condition = Code(condition)
 
-        return self._control_block('elif', condition)
+        return self._control_block('elif', condition, reorderable)
 
-    def ELIF_NOT(self, condition):
-        return self.ELIF(Code('not (', Val(condition), ')'))
+    def ELIF_NOT(self, condition, reorderable=False):
+        return self.ELIF(_node('not', 'not (', Val(condition), ')'), reorderable)
 
     def ELSE(self):
         return self._control_block('else')
 
     def WITH(self, condition, as_=OMITTED):
         if as_ is not OMITTED:
-            condition = Code(Val(condition), ' as ', Code(as_))
+            condition = _node('as', Val(condition), ' as ', Code(as_))
         return self._control_block('with', condition)
 
     def TRY(self):
@@ -147,14 +1017,14 @@ class CodeBuilder:
         if condition is OMITTED and as_ is not OMITTED:
             raise TypeError('Missing exception specifier')
         if as_ is not OMITTED:
-            condition = Code(Val(condition), ' as ', Code(as_))
+            condition = _node('as', Val(condition), ' as ', Code(as_))
         return self._control_block('except', condition)
 
     def FINALLY(self):
         return self._control_block('finally')
 
     def FOR(self, item, in_):
-        return self._control_block('for', Code(Val(item), ' in ', Val(in_)))
+        return self._control_block('for', _node('in', Val(item), ' in ', Val(in_)))
 
     def RETURN(self, obj=OMITTED):
         return self._control_line('return', obj)
@@ -169,36 +1039,442 @@ class CodeBuilder:
         return self._control_line('assert', obj)
 
     def _control_line(self, keyword, obj=OMITTED):
-        return self.append(
-            Code(keyword) if obj is OMITTED else Code(keyword, ' ', Val(obj))
-        )
+        if obj is OMITTED:
+            return self.append(_node('keyword', keyword))
+        return self.append(_node('keyword', keyword, ' ', Val(obj)))
+
+    def fork(self):
+        # Return a builder that can be filled on its own, in another thread or
+        # process, and then spliced back in with merge(). Its variables get
+        # names that can't clash with this builder's names or with the names of
+        # other forks.
+        if self._profile:
+            self._add_profile_table()
+        self._num_forks += 1
+        self._open_forks.add(self._num_forks)
+        child = CodeBuilder.__new__(CodeBuilder)
+        child.__dict__.update(self.__dict__)
+        child.state = dict(self.state)
+        child._root = []
+        child._body = child._statements = []
+        child._names = defaultdict(int)
+        child._local_names = defaultdict(int)
+        child._stream = None
+        child._consed = None if self._consed is None else {}
+        child._root_hoisted = child._hoisted = ChainMap()
+        child._root_scope = _Scope('module')
+        child._scope = _Scope(self._scope.kind, self._scope.parent, self._scope.name)
+        child._outline_temps = set()
+        child.stats = None
+        child._stats_callback = None
+        child._reorderable = {}
+        child._fusable = {}
+        child._allocated = set()
+        child._hoisted_globals = []
+        if self._call_sites is not None:
+            child._call_sites = {}
+        child._name_prefix = f'{self._name_prefix}_{self._num_forks}_'
+        child._num_forks = 0
+        child._open_forks = set()
+
+        # Refer to the parent by id, so that a pickled fork doesn't drag the
+        # parent along with it.
+        child._fork_key = (id(self), self._num_forks)
+        return child
+
+    def merge(self, *forks):
+        # Splice in each fork's global section and then its statements, in
+        # the order given, at the current position.
+        numbers = set()
+        for fork in forks:
+            parent_id, number = fork._fork_key or (None, None)
+            if parent_id != id(self) or number not in self._open_forks - numbers:
+                raise ValueError('Can only merge an unmerged fork of this builder')
+            if fork._statements is not fork._body:
+                raise ValueError('Cannot merge a fork with an open block')
+            numbers.add(number)
+
+        self._open_forks -= numbers
+        for fork in forks:
+            self._reorderable.update(fork._reorderable)
+            self._fusable.update(fork._fusable)
+            self._allocated.update(fork._allocated)
+            self._outline_temps.update(fork._outline_temps)
+            self._hoisted_globals.extend(fork._hoisted_globals)
+            if self._call_sites is not None:
+                for key, value in fork._call_sites.items():
+                    self._call_sites.setdefault(key, value)
+            if fork._root:
+                with self.global_section():
+                    self.extend(fork._root)
+            self.extend(fork._body)
+        return self
+
+    def __getstate__(self):
+        # Tables keyed by ids don't survive pickling, so rebuild their keys from
+        # their values. The hash-consing table just starts over.
+        state = self.__dict__.copy()
+        if self._stream is not None:
+            raise TypeError('Cannot pickle a builder that streams its output')
+        state['_consed'] = None if self._consed is None else {}
+        state['_reorderable'] = list(self._reorderable.values())
+        state['_fusable'] = list(self._fusable.values())
+        if self._call_sites is not None:
+            state['_call_sites'] = list(self._call_sites.values())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reorderable = {id(entry[0]): entry for entry in self._reorderable}
+        self._fusable = {id(block): block for block in self._fusable}
+        if self._call_sites is not None:
+            self._call_sites = {id(entry[0]): entry for entry in self._call_sites}
 
     @contextmanager
     def global_section(self):
-        saved = self._statements, self._num_blocks
+        saved = self._statements, self._num_blocks, self._hoisted, self._scope
         self._statements = self._root
         self._num_blocks = 1
+        self._hoisted = self._root_hoisted
+        self._scope = self._root_scope
         try:
             yield
         finally:
-            self._statements, self._num_blocks = saved
+            self._statements, self._num_blocks, self._hoisted, self._scope = saved
 
     @contextmanager
-    def _control_block(self, keyword, condition=OMITTED):
+    def _control_block(self, keyword, condition=OMITTED, reorderable=False, fuse=False):
+        if condition is not OMITTED:
+            condition = Val(condition)
+
+        # A hoist or a var in an elif's condition adds its statement before the
+        # elif, which would split the if statement.
+        if keyword in _CONTINUATION_KEYWORDS:
+            last = next(
+                (x for x in reversed(self._statements) if not _is_trivia(x)), None
+            )
+            if last is not None and not isinstance(last, _Block):
+                raise ValueError(
+                    f'Cannot add a statement before {keyword}, such as a new'
+                    ' variable from hoist() or var() in its condition'
+                )
+
+        # Label the branches in the order that the generator emits them, so
+        # that a profile from one build applies to the next one.
+        label = None
+        if keyword in _PROFILED_KEYWORDS and (
+            self._profile_branches or self._branch_profile is not None
+        ):
+            scope = self._scope
+            scope.num_probes += 1
+            label = f'{scope.label()}:{keyword}#{scope.num_probes}'
+
+        # Remember which names were bound before the block started, in case
+        # its body gets moved into a helper function.
+        # The names that the header binds are bound everywhere in the block.
+        num_known = 0
+        entry_names = ()
+        scope = self._scope
+        is_loop = keyword == 'for' or keyword == 'while'
+        if self._outline:
+            if condition is not OMITTED and condition._kind in ('in', 'as'):
+                entry_names = self._record_bindings(condition)
+            num_known = len(scope.names)
+
         with self._new_block() as block:
+            if self._profile_branches and label is not None:
+                self._add_profile_table()
+                self.append(Code(f'_profile_counts[{label!r}] += 1'))
+            scope.num_loops += is_loop
+            scope.bound.append(set(entry_names))
+            try:
+                yield
+            finally:
+                scope.num_loops -= is_loop
+                scope.bound.pop()
+
+        if self._outline:
+            in_loop = is_loop or scope.num_loops > 0
+            block = self._maybe_outline(block, num_known, in_loop, entry_names)
+
+        extra = () if condition is OMITTED else (' ', condition)
+        self.append(_node('header', keyword, *extra, ':'))
+        block = _Block(block)
+        self.append(block)
+        if fuse and self._peephole_rules is not None:
+            self._fusable[id(block)] = block
+
+        if reorderable and self._branch_profile is not None:
+            count = self._branch_profile.get(label, 0)
+            self._reorderable[id(block)] = (block, count)
+            if keyword == 'elif':
+                self._promote_clause(count)
+
+    def _promote_clause(self, count):
+        # Move the last clause of an if statement ahead of the reorderable
+        # clauses right before it that were taken less often.
+        statements = self._statements
+        index = len(statements) - 2
+        while index >= 2:
+            entry = self._reorderable.get(id(statements[index - 1]))
+            if entry is None or entry[0] is not statements[index - 1]:
+                break
+            if entry[1] >= count:
+                break
+            index -= 2
+            if statements[index]._parts[0] == 'if':
+                break
+
+        if index == len(statements) - 2:
+            return
+
+        header, block = statements[-2:]
+        del statements[-2:]
+        if statements[index]._parts[0] == 'if':
+            statements[index] = _node('header', 'elif', *statements[index]._parts[1:])
+            header = _node('header', 'if', *header._parts[1:])
+        statements[index:index] = [header, block]
+
+    def _maybe_outline(self, statements, num_known, in_loop=False, entry_names=()):
+        scope = self._scope
+        if scope.kind == 'class':
+            return statements
+
+        depth = max((x._depth for x in statements if isinstance(x, _Block)), default=0)
+        if self._num_blocks + 1 + depth > self._max_num_blocks:
+            outlined = self._outline_block(statements, num_known, in_loop, entry_names)
+            return outlined or statements
+
+        # Only outline blocks that are bigger than the call that replaces them.
+        budget = self._max_function_statements
+        over_budget = budget is not None and scope.size > budget
+        if (
+            scope.kind == 'function'
+            and over_budget
+            and _count_statements(statements) > 3
+        ):
+            outlined = self._outline_block(statements, num_known, in_loop, entry_names)
+            return outlined or statements
+
+        return statements
+
+    def _outline_block(self, statements, num_known, in_loop=False, entry_names=()):
+        # Move the statements into a new function in the global section, and
+        # return the statements that call it. Return None if the statements
+        # can't be moved.
+        scope = self._scope
+        writer = _Writer(self._render_cache_limit)
+        for statement in statements:
+            writer.write_line(statement)
+        try:
+            body = ast.parse(writer.getvalue()).body
+        except SyntaxError:
+            return None
+
+        loads, stores, has_return, movable = _scan_block(body, scope.in_class)
+
+        # The temporaries of nested calls are only used right after each call.
+        stores -= self._outline_temps
+        if not movable or (has_return and scope.kind == 'module'):
+            return None
+
+        if scope.kind == 'module':
+            # At the top level, the function can just update the globals.
+            inputs, outputs = [], []
+            prologue = [ast.Global(sorted(stores))] if stores else []
+        else:
+            # Pass in every local that the block uses and that was already
+            # bound, and pass back everything that the block binds. Names that
+            # the block binds for the first time start out as None.
+            inputs = sorted(
+                name
+                for name in loads | stores
+                if scope.names.get(name, num_known) < num_known
+                or (name in loads and scope.is_free(name))
+            )
+            outputs = sorted(stores)
+            fresh = [name for name in outputs if name not in inputs]
+
+            # The call reads every input, so each one must be bound on every
+            # path to the block, even if the block only reads it on some paths.
+            bound = set(entry_names).union(*scope.bound)
+            if any(name not in bound and name in scope.names for name in inputs):
+                return None
+            prologue = []
+            if in_loop:
+                # In a loop, a name that the block binds for the first time may
+                # hold a value from the last iteration, so pass it in as well.
+                # It starts out as None at the top of the function instead.
+                inputs = sorted({*inputs, *fresh})
+            elif fresh:
+                targets = [ast.Name(name, _STORE) for name in fresh]
+                prologue.append(ast.Assign(targets, ast.Constant(None)))
+
+        def pack(*values):
+            elts = [ast.Constant(x) for x in values]
+            elts.extend(ast.Name(name, _LOAD) for name in outputs)
+            return ast.Tuple(elts, _LOAD)
+
+        if has_return:
+            _ReturnPacker(len(outputs)).visit(ast.Module(body, []))
+            body.append(ast.Return(pack(False, None)))
+        elif outputs:
+            body.append(ast.Return(pack()))
+
+        with self.global_section():
+            name = repr(self._reserve_name('_outlined'))
+            params = ', '.join(inputs)
+            helper = ast.parse(f'def {name}({params}): pass').body[0]
+            helper.body = prologue + body
+            helper = Code(ast.unparse(ast.fix_missing_locations(helper)))
+            self.append(helper)
+            self.add_newline()
+
+        call = Code(name)(*map(Code, inputs))
+        output_names = tuple(map(Code, outputs))
+        if has_return:
+            flag = self._reserve_name('_returned')
+            value = self._reserve_name('_value')
+            self._outline_temps.update([repr(flag), repr(value)])
+            result = [
+                (flag, value, *output_names) << call,
+                _node('header', 'if', ' ', flag, ':'),
+                _Block([_node('keyword', 'return', ' ', value)]),
+            ]
+        elif outputs:
+            result = [output_names << call]
+        else:
+            result = [call]
+
+        if scope.kind == 'function':
+            scope.size -= _count_statements(statements) - _count_statements(result)
+            # The helper reads the names that it doesn't take as globals. If
+            # the function binds one of them later in a loop, then the block
+            # would have read its value from the last iteration. Since the
+            # block's list becomes the list of its _Block, the outline can be
+            # undone in place when the function ends.
+            globals_read = loads - set(inputs) - stores if in_loop else set()
+            fresh = fresh if in_loop else []
+            entry = (result, statements, globals_read, helper, fresh)
+            scope.outlines.append(entry)
+        return result
+
+    def _finish_outlines(self, scope, statements):
+        # Undo the outlines that read a name that turned out to be local, along
+        # with the outlines around them, since their helpers call the undone
+        # helpers. Then bind the names that the loops pass in at the top of the
+        # function.
+        undone = {
+            id(entry[0])
+            for entry in scope.outlines
+            if not entry[2].isdisjoint(scope.names)
+        }
+        changed = bool(undone)
+        while changed:
+            changed = False
+            for entry in scope.outlines:
+                if id(entry[0]) not in undone and _contains_any(entry[1], undone):
+                    undone.add(id(entry[0]))
+                    changed = True
+
+        fresh_names = set()
+        for result, original, globals_read, helper, fresh in scope.outlines:
+            if id(result) not in undone:
+                fresh_names.update(fresh)
+                continue
+            result[:] = original
+            for index, statement in enumerate(self._root):
+                if statement is helper:
+                    del self._root[index : index + 2]
+                    break
+
+        if fresh_names:
+            start = 1 if statements and _is_docstring(statements[0]) else 0
+            names = ' = '.join(sorted(fresh_names))
+            statements.insert(start, Code(f'{names} = None'))
+
+    def _record_bindings(self, statement):
+        scope = self._scope
+        if scope.kind != 'function' or not isinstance(statement, Code):
+            return ()
+
+        kind = statement._kind
+        if kind == 'assign' or kind == 'in':
+            names = _target_names(statement._parts[0])
+        elif kind == 'as':
+            names = _target_names(statement._parts[2])
+        elif kind == 'def' or kind == 'class':
+            names = [statement._parts[1]]
+        elif kind is None:
+            try:
+                tree = ast.parse(repr(statement))
+            except SyntaxError:
+                names = ()
+            else:
+                names = _scan_block(tree.body, scope.in_class)[1]
+                self._record_opaque_bindings(tree.body)
+        else:
+            names = ()
+
+        if kind not in ('in', 'as', 'comment'):
+            scope.size += 1
+        for name in names:
+            scope.names.setdefault(name, len(scope.names))
+
+        # The names that a simple statement binds are bound on every path
+        # through the rest of the block. An opaque fragment only counts for the
+        # simple statements in it.
+        if kind not in ('in', 'as', None):
+            scope.bound[-1].update(names)
+        return names
+
+    def _record_opaque_bindings(self, body):
+        scope = self._scope
+        for node in body:
+            if isinstance(node, ast.Delete):
+                deleted = {x.id for x in ast.walk(node) if isinstance(x, ast.Name)}
+                for names in scope.bound:
+                    names -= deleted
+            elif not isinstance(node, _COMPOUND_STATEMENTS):
+                scope.bound[-1].update(_scan_block([node], scope.in_class)[1])
+
+    @contextmanager
+    def _new_scope(self, kind, params=(), name=None):
+        saved = self._scope
+        self._scope = _Scope(kind, saved, name)
+        enclosing = saved
+        while enclosing is not None and enclosing.kind != 'function':
+            enclosing = enclosing.parent
+        if kind == 'function' and enclosing is not None:
+            self._scope.counters.update(enclosing.counters)
+        if self._outline and params:
+            args = _parse_parameters(', '.join(params))
+            for arg in (*args.posonlyargs, *args.args, *args.kwonlyargs):
+                self._scope.names.setdefault(arg.arg, len(self._scope.names))
+                self._scope.bound[0].add(arg.arg)
+            for arg in (args.vararg, args.kwarg):
+                if arg is not None:
+                    self._scope.names.setdefault(arg.arg, len(self._scope.names))
+                    self._scope.bound[0].add(arg.arg)
+        try:
             yield
-        extra = () if condition is OMITTED else (' ', Val(condition))
-        self.append(Code(keyword, *extra, ':'))
-        self.append(_Block(block))
+        finally:
+            self._scope = saved
 
     @contextmanager
     def _new_block(self):
         with self._sandbox() as new_buffer:
             self._num_blocks += 1
+            stats = self.stats
+            if stats is not None and self._num_blocks > stats.peak_num_blocks:
+                stats.peak_num_blocks = self._num_blocks
+            saved_hoisted = self._hoisted
+            self._hoisted = saved_hoisted.new_child()
             try:
                 yield new_buffer
             finally:
                 self._num_blocks -= 1
+                self._hoisted = saved_hoisted
 
     @contextmanager
     def _sandbox(self):
@@ -210,24 +1486,481 @@ class CodeBuilder:
             self._statements = saved
 
 
+@contextmanager
+def _gc_paused():
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def compile_many(builders, module_names=None, cache=None, executor=None):
+    builders = list(builders)
+    if module_names is None:
+        module_names = ['code'] * len(builders)
+
+    jobs = [
+        (b.source_code(minimal_parens=True), name)
+        for b, name in zip(builders, module_names)
+    ]
+    code_objects = _compile_all(jobs, cache, executor)
+    return [
+        _new_module(name, None, [code_object], None, None)
+        for name, code_object in zip(module_names, code_objects)
+    ]
+
+
+def _compile_all(jobs, cache=None, executor=None):
+    # Compile (source_code, module_name) pairs, or (source_code, module_name,
+    # flags) triples, in a process pool when there is more than one of them to
+    # compile.
+    results = [None] * len(jobs)
+    keys = [None] * len(jobs)
+    missing = []
+    for index, job in enumerate(jobs):
+        if cache is not None:
+            keys[index] = _cache_key(*job)
+            results[index] = cache.load(keys[index])
+        if results[index] is None:
+            missing.append(index)
+
+    if len(missing) > 1:
+        pending = [jobs[index] for index in missing]
+        if executor is None:
+            with ProcessPoolExecutor() as pool:
+                payloads = list(pool.map(_compile_to_bytes, pending))
+        else:
+            payloads = list(executor.map(_compile_to_bytes, pending))
+        compiled = [marshal.loads(payload) for payload in payloads]
+    else:
+        compiled = [_compile_job(jobs[index]) for index in missing]
+
+    for index, code_object in zip(missing, compiled):
+        results[index] = code_object
+        if cache is not None:
+            cache.store(keys[index], code_object)
+
+    return results
+
+
+def _compile_to_bytes(job):
+    # Code objects can't be pickled, so workers send them back marshalled.
+    return marshal.dumps(_compile_job(job))
+
+
+def _compile_job(job):
+    source_code, module_name, *flags = job
+    return _compile_source(source_code, module_name, None, *flags)
+
+
+def _is_trivia(statement):
+    if isinstance(statement, str):
+        return statement == ''
+    return isinstance(statement, Code) and statement._kind == 'comment'
+
+
+def _continues_statement(statement):
+    if isinstance(statement, _Block):
+        return True
+    return (
+        isinstance(statement, Code)
+        and statement._kind == 'header'
+        and statement._parts[0] in _CONTINUATION_KEYWORDS
+    )
+
+
+def _new_module(module_name, docstring, code_objects, source_var, source_code):
+    module = types.ModuleType(module_name, doc=docstring)
+    for code_object in code_objects:
+        _run_code(code_object, module.__dict__)
+
+    # Optionally assign the source code to a variable in the module.
+    if source_var is not None:
+        setattr(module, source_var, source_code)
+
+    return module
+
+
+def _run_code(code_object, namespace):
+    exec(code_object, namespace)
+
+
+_PACKAGE_LOADER = """\
+from importlib.util import find_spec as _find_spec
+
+
+def _outsourcer_load(name):
+    spec = _find_spec(f'{__name__}.{name}')
+    exec(spec.loader.get_code(spec.name), globals())
+
+"""
+
+
+def _write_source(path, source_code, check_source, optimize):
+    # Write the source file and a hash-based .pyc file next to it, in the
+    # layout that importlib expects (see PEP 552).
+    data = source_code.encode('utf-8')
+    code_object = compile(data, path, 'exec', dont_inherit=True, optimize=optimize)
+    flags = 0b11 if check_source else 0b01
+    pyc = bytearray(importlib.util.MAGIC_NUMBER)
+    pyc.extend(flags.to_bytes(4, 'little'))
+    pyc.extend(importlib.util.source_hash(data))
+    pyc.extend(marshal.dumps(code_object))
+
+    pyc_path = importlib.util.cache_from_source(path, optimization=optimize or '')
+    os.makedirs(os.path.dirname(pyc_path), exist_ok=True)
+    _write_atomically(path, data)
+    _write_atomically(pyc_path, pyc)
+
+
+def _write_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(temp_path)
+        raise
+
+
+def _call_site():
+    # Find the generator code that appended a statement, skipping the frames
+    # of this module and of contextlib.
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename in _INTERNAL_FILES:
+        frame = frame.f_back
+    return None if frame is None else (frame.f_code.co_filename, frame.f_lineno)
+
+
+_INTERNAL_FILES = frozenset(
+    [_call_site.__code__.co_filename, contextmanager.__code__.co_filename]
+)
+
+
+def _lazy_function(namespace, functions, module_name, cache, flags, index):
+    name, source_code = functions[index]
+    lock = threading.Lock()
+    compiled = None
+
+    def stub(*args, **kwargs):
+        nonlocal compiled
+        if compiled is None:
+            with lock:
+                if compiled is None:
+                    # Running the def statement rebinds the name to the real
+                    # function. If the module rebound the name to something else
+                    # (a decorator, say), then put that back.
+                    previous = namespace.get(name)
+                    code_object = _compile_source(
+                        source_code, module_name, cache, flags
+                    )
+                    _run_code(code_object, namespace)
+                    function = namespace[name]
+                    if previous is not stub:
+                        namespace[name] = previous
+                    compiled = function
+        return compiled(*args, **kwargs)
+
+    stub.__name__ = stub.__qualname__ = name
+    stub.__module__ = module_name
+    return stub
+
+
+def _compile_source(source_code, module_name, cache=None, flags=0):
+    filename = f'<{module_name}>'
+    if cache is None:
+        return compile(source_code, filename, 'exec', flags, optimize=2)
+
+    if isinstance(source_code, ast.AST):
+        # The line numbers end up in the code object, so they're part of the key.
+        dump = ast.dump(source_code, include_attributes=True)
+        key = _cache_key(dump, module_name, flags)
+    else:
+        key = _cache_key(source_code, module_name, flags)
+    code_object = cache.load(key)
+    if code_object is None:
+        code_object = compile(source_code, filename, 'exec', flags, optimize=2)
+        cache.store(key, code_object)
+    return code_object
+
+
+def _cache_key(source_code, module_name, flags=0):
+    # The module name ends up in the code object's filename, and the marshal
+    # format is only stable within a single Python version.
+    digest = hashlib.sha256()
+    for part in (sys.version, module_name, str(flags), source_code):
+        digest.update(part.encode('utf-8', 'surrogatepass'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _future_flags(source_code):
+    # Return the compiler flags of the __future__ imports at the start of a
+    # module, so that other parts of the module can be compiled with them.
+    flags = 0
+    if '__future__' not in source_code:
+        return flags
+    try:
+        body = ast.parse(source_code).body
+    except SyntaxError:
+        return flags
+    if body and _is_docstring_node(body[0]):
+        body = body[1:]
+    for statement in body:
+        if not isinstance(statement, ast.ImportFrom):
+            break
+        if statement.module != '__future__':
+            break
+        for alias in statement.names:
+            feature = getattr(__future__, alias.name, None)
+            if feature is not None:
+                flags |= feature.compiler_flag
+    return flags
+
+
+def _is_future_import(source_code):
+    if '__future__' not in source_code:
+        return False
+    try:
+        body = ast.parse(source_code).body
+    except SyntaxError:
+        return False
+    return bool(body) and all(
+        isinstance(x, ast.ImportFrom) and x.module == '__future__' for x in body
+    )
+
+
+def _is_docstring_node(node):
+    return (
+        isinstance(node, ast.Expr)
+        and isinstance(node.value, ast.Constant)
+        and isinstance(node.value.value, str)
+    )
+
+
+class BuildStats:
+    # Measures each phase of producing a module: building the tree, rendering
+    # it (or lowering it, in the ast mode), compiling it, and executing it.
+    # The build phase runs from the creation of the builder (or the last call
+    # to reset) until it first produces output.
+    def __init__(self):
+        self.phases = {}
+        self.num_nodes = 0
+        self.max_depth = 0
+        self.num_lines = 0
+        self.num_bytes = 0
+        self.num_blocks = 0
+        self.peak_num_blocks = 1
+        self._build_start = _PhaseStart()
+
+    def reset(self):
+        self.phases.clear()
+        self._build_start = _PhaseStart()
+
+    @contextmanager
+    def measure(self, phase):
+        if self._build_start is not None:
+            self._end_phase('build', self._build_start)
+            self._build_start = None
+
+        start = _PhaseStart()
+        try:
+            yield
+        finally:
+            self._end_phase(phase, start)
+
+    def as_dict(self):
+        return {
+            'phases': {name: dict(phase) for name, phase in self.phases.items()},
+            'num_nodes': self.num_nodes,
+            'max_depth': self.max_depth,
+            'num_lines': self.num_lines,
+            'num_bytes': self.num_bytes,
+            'num_blocks': self.num_blocks,
+            'peak_num_blocks': self.peak_num_blocks,
+        }
+
+    def _end_phase(self, phase, start):
+        # Allocations are the net change in the number of allocated memory
+        # blocks, and in bytes, if tracemalloc is tracing.
+        allocated_bytes = None
+        if start.traced is not None and tracemalloc.is_tracing():
+            allocated_bytes = tracemalloc.get_traced_memory()[0] - start.traced
+
+        self.phases[phase] = {
+            'wall_time': time.perf_counter() - start.time,
+            'allocated_blocks': sys.getallocatedblocks() - start.blocks,
+            'allocated_bytes': allocated_bytes,
+        }
+
+    def _record_output(self, statements, source_code):
+        self.num_nodes, self.max_depth, self.num_blocks = _tree_size(statements)
+        if source_code is not None:
+            self.num_lines = source_code.count('\n')
+            self.num_bytes = len(source_code.encode('utf-8', 'surrogatepass'))
+
+
+class _PhaseStart:
+    __slots__ = ('blocks', 'time', 'traced')
+
+    def __init__(self):
+        self.traced = None
+        if tracemalloc.is_tracing():
+            self.traced = tracemalloc.get_traced_memory()[0]
+        self.blocks = sys.getallocatedblocks()
+        self.time = time.perf_counter()
+
+
+def _tree_size(statements):
+    # Count every occurrence of a fragment, since that's what rendering sees.
+    num_nodes, max_depth, num_blocks = 0, 0, 0
+    stack = [(x, 1) for x in statements]
+    while stack:
+        item, depth = stack.pop()
+        if isinstance(item, _Block):
+            num_blocks += 1
+            stack.extend((x, 1) for x in item._statements)
+        elif isinstance(item, Code):
+            num_nodes += 1
+            max_depth = max(max_depth, depth)
+            stack.extend((x, depth + 1) for x in item._parts if isinstance(x, Code))
+    return num_nodes, max_depth, num_blocks
+
+
+class MemoryCache:
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, key):
+        with self._lock:
+            code_object = self._entries.get(key)
+            if code_object is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return code_object
+
+    def store(self, key, code_object):
+        with self._lock:
+            self._entries[key] = code_object
+            self._entries.move_to_end(key)
+            while self.max_size is not None and len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+class DiskCache:
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = os.fspath(directory)
+        self.max_size = max_size
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                code_object = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        # Bump the modification time so that eviction treats it as fresh.
+        with suppress(OSError):
+            os.utime(path)
+
+        return code_object if isinstance(code_object, types.CodeType) else None
+
+    def store(self, key, code_object):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(code_object, f)
+            # Concurrent writers race harmlessly: os.replace is atomic.
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            with suppress(OSError):
+                os.unlink(temp_path)
+            raise
+        self._evict()
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            with suppress(OSError):
+                os.unlink(path)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.marshal')
+
+    def _entries(self):
+        result = []
+        with suppress(FileNotFoundError), os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.marshal'):
+                    continue
+                with suppress(OSError):
+                    info = entry.stat()
+                    result.append((entry.path, info.st_mtime, info.st_size))
+        return result
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+
+        # Remove the least recently used entries until we fit.
+        entries.sort(key=lambda entry: entry[1])
+        for path, _, size in entries:
+            if total <= self.max_size:
+                break
+            with suppress(OSError):
+                os.unlink(path)
+            total -= size
+
+
 class Code:
+    __slots__ = ('__weakref__', '_bare_text', '_kind', '_parts', '_text')
+
     def __init__(self, *parts):
         self._parts = parts
-
-    def _write(self, writer):
-        for part in self._parts:
-            writer.write(part)
+        self._kind = None
+        self._text = None
+        self._bare_text = None
 
     def __repr__(self):
         writer = _Writer()
-        self._write(writer)
+        writer.write(self)
         return writer.getvalue()
 
     def __lshift__(self, other):
-        return Code(self, ' = ', Val(other))
+        return _node('assign', self, ' = ', Val(other))
 
     def __rlshift__(self, other):
-        return Code(Val(other), ' = ', self)
+        return _node('assign', Val(other), ' = ', self)
+
+    def __reduce__(self):
+        # Spell this out, since __getattr__ would make up the other methods
+        # that pickle looks for.
+        return _node, (self._kind, *self._parts)
 
     def __call__(self, *args, **kwargs):
         parts = [self, '(']
@@ -243,25 +1976,25 @@ class Code:
             parts.pop()
 
         parts.append(')')
-        return Code(*parts)
+        return _node('call', *parts)
 
     def __getitem__(self, key):
-        return Code(self, '[', Val(key), ']')
+        return _node('subscript', self, '[', Val(key), ']')
 
     def __getattr__(self, name):
-        return Code(self, '.', name)
+        return _node('attribute', self, '.', name)
 
     def __neg__(self):
-        return Code('(-', self, ')')
+        return _node('unary', '(-', self, ')')
 
     def __pos__(self):
-        return Code('(+', self, ')')
+        return _node('unary', '(+', self, ')')
 
     def __invert__(self):
-        return Code('(~', self, ')')
+        return _node('unary', '(~', self, ')')
 
     def __abs__(self):
-        return Code('abs(', self, ')')
+        return _node('name', 'abs')(self)
 
     def __eq__(self, other):
         return _binop(self, '==', other)
@@ -355,60 +2088,1731 @@ class Code:
 
 
 def Val(obj):
-    return obj if isinstance(obj, Code) else Code(repr(obj))
+    if isinstance(obj, Code):
+        return obj
+
+    kind = type(obj)
+    if kind in _LITERAL_TYPES and (kind is not float or math.isfinite(obj)):
+        # Use the repr for floats, so that 0.0 and -0.0 stay different.
+        key = (kind, repr(obj) if kind is float else obj)
+        return _interned(_interned_literals, key, 'literal', obj)
+
+    # Keep the structure of containers that hold code fragments, so that they
+    # can be lowered without parsing. Their text still matches repr(obj).
+    if kind in (tuple, list, set) and any(isinstance(x, Code) for x in obj):
+        if kind is tuple and len(obj) == 1:
+            return _node('tuple', '(', Val(obj[0]), ',)')
+        left, right = '()' if kind is tuple else '[]' if kind is list else '{}'
+        return _node(kind.__name__, left, *_separated(map(Val, obj), ', '), right)
+
+    if kind is dict and any(isinstance(x, Code) for x in (*obj, *obj.values())):
+        items = [_node(None, Val(k), ': ', Val(v)) for k, v in obj.items()]
+        return _node('dict', '{', *_separated(items, ', '), '}')
+
+    if kind is slice:
+        bounds = (obj.start, obj.stop, obj.step)
+        if any(isinstance(x, Code) for x in bounds):
+            return _node('name', 'slice')(*bounds)
+
+    return Code(repr(obj))
 
 
 def Yield(obj):
-    return Code('(yield ', Val(obj), ')')
+    return _node('yield', '(yield ', Val(obj), ')')
+
+
+def structure_key(code):
+    # Digest each fragment from its kind, its plain parts and the digests of
+    # its child fragments, working bottom up without recursion.
+    code = Val(code)
+    digests = {}
+    stack = [code]
+    while stack:
+        node = stack[-1]
+        if id(node) in digests:
+            stack.pop()
+            continue
+
+        pending = [
+            part
+            for part in node._parts
+            if isinstance(part, Code) and id(part) not in digests
+        ]
+        if pending:
+            stack.extend(pending)
+            continue
+
+        stack.pop()
+        digest = hashlib.blake2b(repr(node._kind).encode(), digest_size=16)
+        for part in node._parts:
+            if isinstance(part, Code):
+                digest.update(b'\x01' + digests[id(part)])
+            else:
+                text = f'{type(part).__name__}:{part!r}'
+                digest.update(b'\x02' + text.encode('utf-8', 'surrogatepass'))
+                digest.update(b'\x00')
+        digests[id(node)] = digest.digest()
+
+    return digests[id(code)]
+
+
+def _part_key(part):
+    if isinstance(part, Code):
+        return id(part)
+    # Keep True, 1 and 1.0 apart, and 0.0 and -0.0 as well.
+    return (type(part), repr(part) if type(part) is float else part)
+
+
+# Values that round-trip through repr() and that ast.Constant accepts.
+_LITERAL_TYPES = frozenset([bool, bytes, float, int, str, type(None)])
+
+
+# Fragments are never modified after they are created, so identical leaves can
+# share a single instance. The caches only hold on to the ones still in use.
+_interned_literals = weakref.WeakValueDictionary()
+_interned_names = weakref.WeakValueDictionary()
+
+
+def _interned(cache, key, kind, value):
+    result = cache.get(key)
+    if result is None:
+        result = cache[key] = _node(kind, value)
+    return result
+
+
+def _separated(items, separator):
+    result = []
+    for item in items:
+        result.extend([item, separator])
+    return result[:-1]
+
+
+def _node(kind, *parts):
+    # Tag a fragment with its kind, so that later passes can see its structure.
+    # The parts of each kind follow a fixed layout; see _lower_expression.
+    result = Code(*parts)
+    result._kind = kind
+    return result
 
 
 class _Block:
+    __slots__ = ('_depth', '_statements')
+
     def __init__(self, statements):
         self._statements = statements or ['pass']
+        self._depth = 1 + max(
+            (x._depth for x in statements if isinstance(x, _Block)), default=0
+        )
 
-    def _write_block(self, writer):
-        with writer.indented():
-            for statement in self._statements:
-                writer.write_line(statement)
+
+class _Scope:
+    # Tracks the names that a function binds, in the order that they were first
+    # bound, along with the number of statements in its body so far. With
+    # scoped names, it also tracks the variables that var() reserved in it.
+    __slots__ = (
+        'bound',
+        'counters',
+        'in_class',
+        'kind',
+        'name',
+        'names',
+        'num_loops',
+        'num_probes',
+        'outlines',
+        'parent',
+        'released',
+        'size',
+        'temporaries',
+    )
+
+    def __init__(self, kind, parent=None, name=None):
+        self.kind = kind
+        self.parent = parent
+        self.name = name
+        self.names = {}
+        self.size = 0
+        self.num_probes = 0
+        self.num_loops = 0
+        self.bound = [set()]
+        self.outlines = []
+        self.counters = defaultdict(int)
+        self.temporaries = {}
+        self.released = {}
+        self.in_class = parent is not None and (
+            parent.kind == 'class' or parent.in_class
+        )
+
+    def label(self):
+        names = []
+        scope = self
+        while scope.parent is not None:
+            names.append(scope.name)
+            scope = scope.parent
+        return '.'.join(reversed(names)) or '<module>'
+
+    def is_free(self, name):
+        scope = self.parent
+        while scope is not None:
+            if scope.kind == 'function' and name in scope.names:
+                return True
+            scope = scope.parent
+        return False
+
+
+_PROFILED_KEYWORDS = frozenset(['if', 'elif', 'else', 'for', 'while'])
+
+
+def read_profile(module):
+    # Return the counts and cumulative times of a module that was built with
+    # profiling, keyed by function name, or by function name and branch.
+    counts = getattr(module, '_profile_counts', {})
+    times = getattr(module, '_profile_times', {})
+    return {
+        label: {'count': count, 'time': times.get(label)}
+        for label, count in sorted(counts.items())
+    }
+
+
+_PROFILE_FORMAT = 'outsourcer-profile'
+_PROFILE_VERSION = 1
+
+
+def save_profile(module, path):
+    # Profiles are JSON, with sorted keys, so that they diff well.
+    counts = {label: entry['count'] for label, entry in read_profile(module).items()}
+    document = {
+        'format': _PROFILE_FORMAT,
+        'version': _PROFILE_VERSION,
+        'counts': counts,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(document, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def load_profile(path):
+    with open(path, encoding='utf-8') as f:
+        document = json.load(f)
+
+    if (
+        not isinstance(document, dict)
+        or document.get('format') != _PROFILE_FORMAT
+        or document.get('version') != _PROFILE_VERSION
+    ):
+        raise ValueError(f'Not a version {_PROFILE_VERSION} profile: {path}')
+    return document['counts']
+
+
+def reset_profile(module):
+    for name in ('_profile_counts', '_profile_times'):
+        table = getattr(module, name, None)
+        if table is not None:
+            table.clear()
+
+
+def _count_statements(statements):
+    count = 0
+    stack = list(statements)
+    while stack:
+        statement = stack.pop()
+        if isinstance(statement, _Block):
+            stack.extend(statement._statements)
+        elif not _is_trivia(statement):
+            count += 1
+    return count
+
+
+def _target_names(target):
+    if target._kind == 'name':
+        return [target._parts[0]]
+
+    try:
+        node = ast.parse(repr(target), mode='eval').body
+    except SyntaxError:
+        return []
+
+    names, stack = [], [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Name):
+            names.append(node.id)
+        elif isinstance(node, (ast.Tuple, ast.List)):
+            stack.extend(node.elts)
+        elif isinstance(node, ast.Starred):
+            stack.append(node.value)
+    return names
+
+
+_NAMED_TARGETS = (ast.ExceptHandler, ast.MatchAs, ast.MatchStar)
+
+
+def _bound_names(tree):
+    # Find every name that a tree binds or deletes, in any scope, along with
+    # the attribute names that it assigns or deletes.
+    names, attributes = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, ast.Attribute) and not isinstance(node.ctx, ast.Load):
+            attributes.add(node.attr)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update(x.asname or x.name.partition('.')[0] for x in node.names)
+        elif isinstance(node, _NESTED_SCOPES) and not isinstance(node, ast.expr):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, _NAMED_TARGETS) and node.name:
+            names.add(node.name)
+    return names, attributes
+
+
+def _rebound_globals(tree):
+    # Find the names that the module assigns outside of its functions and
+    # classes, and the names that any function declares global.
+    names = set()
+    stack = [(tree, True)]
+    while stack:
+        node, top_level = stack.pop()
+        is_store = isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load)
+        if isinstance(node, ast.Global):
+            names.update(node.names)
+        elif top_level and is_store:
+            names.add(node.id)
+        top_level = top_level and not isinstance(node, _NESTED_SCOPES)
+        stack.extend((x, top_level) for x in ast.iter_child_nodes(node))
+    return names
+
+
+def _is_builtin_lookup(node, bound):
+    if node._kind == 'name':
+        return hasattr(builtins, node._parts[0])
+    obj, _, name = node._parts
+    base = obj._parts[0]
+    if base in bound or not hasattr(builtins, base):
+        return False
+    return hasattr(getattr(builtins, base), name)
+
+
+def _attribute_chain(node):
+    # Return the names in a chain of attributes like `a.b.c`, or None.
+    attributes = []
+    while node._kind == 'attribute':
+        attributes.append(node._parts[2])
+        node = node._parts[0]
+        if not isinstance(node, Code):
+            return None
+    if not attributes or node._kind != 'name' or not node._parts[0].isidentifier():
+        return None
+    return [node._parts[0], *reversed(attributes)]
+
+
+def _replace_in_block(statements, replacements, memo):
+    result = []
+    skip = False
+    for statement in statements:
+        if isinstance(statement, _Block):
+            if not skip:
+                body = _replace_in_block(statement._statements, replacements, memo)
+                statement = _Block(body)
+        elif isinstance(statement, Code):
+            skip = statement._kind in ('def', 'class')
+            if not skip:
+                statement = _replace_nodes(statement, replacements, memo)
+        result.append(statement)
+    return result
+
+
+def _replace_nodes(expr, replacements, memo):
+    stack = [expr]
+    while stack:
+        node = stack[-1]
+        if id(node) in memo:
+            stack.pop()
+            continue
+
+        replacement = replacements.get(id(node))
+        if replacement is not None:
+            stack.pop()
+            memo[id(node)] = replacement
+            continue
+
+        pending = [
+            part
+            for part in node._parts
+            if isinstance(part, Code) and id(part) not in memo
+        ]
+        if pending:
+            stack.extend(pending)
+            continue
+
+        stack.pop()
+        parts = tuple(
+            memo[id(part)] if isinstance(part, Code) else part for part in node._parts
+        )
+        if any(a is not b for a, b in zip(parts, node._parts)):
+            memo[id(node)] = _node(node._kind, *parts)
+        else:
+            memo[id(node)] = node
+
+    return memo[id(expr)]
+
+
+_COMPOUND_STATEMENTS = (
+    ast.If,
+    ast.For,
+    ast.AsyncFor,
+    ast.While,
+    ast.With,
+    ast.AsyncWith,
+    ast.Try,
+    ast.Match,
+)
+
+_NESTED_SCOPES = (
+    ast.FunctionDef,
+    ast.AsyncFunctionDef,
+    ast.ClassDef,
+    ast.Lambda,
+    ast.ListComp,
+    ast.SetComp,
+    ast.DictComp,
+    ast.GeneratorExp,
+)
+
+_UNMOVABLE = (
+    ast.Yield,
+    ast.YieldFrom,
+    ast.Await,
+    ast.AsyncFor,
+    ast.AsyncWith,
+    ast.Global,
+    ast.Nonlocal,
+)
+
+
+def _scan_block(body, in_class=False):
+    # Find the names that a block reads and binds in its own scope, and check
+    # whether the block could run inside a function of its own: it can't yield,
+    # delete names, or break out of a loop that it doesn't contain. In a class,
+    # it also can't use super() or private names, which depend on the class.
+    loads, stores = set(), set()
+    has_return, movable = False, True
+    stack = [(node, 0) for node in body]
+    while stack:
+        node, num_loops = stack.pop()
+
+        if isinstance(node, _NESTED_SCOPES):
+            if not isinstance(node, ast.expr):
+                stores.add(node.name)
+            loads.update(x.id for x in ast.walk(node) if isinstance(x, ast.Name))
+            continue
+
+        is_jump = isinstance(node, (ast.Break, ast.Continue))
+        if isinstance(node, _UNMOVABLE) or (is_jump and not num_loops):
+            movable = False
+        elif isinstance(node, ast.Return):
+            has_return = True
+        elif isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loads.add(node.id)
+            elif isinstance(node.ctx, ast.Store):
+                stores.add(node.id)
+            else:
+                movable = False
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                stores.add(alias.asname or alias.name.partition('.')[0])
+        elif isinstance(node, ast.Attribute) and in_class and _is_private(node.attr):
+            movable = False
+
+        if isinstance(node, (ast.For, ast.While)):
+            # Only the body of a loop belongs to it. A break in its else
+            # clause leaves the enclosing loop.
+            stack.extend((x, num_loops + 1) for x in node.body)
+            for field in ('target', 'iter', 'test'):
+                child = getattr(node, field, None)
+                if child is not None:
+                    stack.append((child, num_loops))
+            stack.extend((x, num_loops) for x in node.orelse)
+        else:
+            stack.extend((x, num_loops) for x in ast.iter_child_nodes(node))
+
+    if in_class:
+        for name in loads | stores:
+            if name in ('super', '__class__') or _is_private(name):
+                movable = False
+    stores.discard('*')
+    return loads, stores, has_return, movable
+
+
+def _is_docstring(statement):
+    return (
+        isinstance(statement, Code)
+        and statement._kind is None
+        and repr(statement).startswith('"""')
+    )
+
+
+def _contains_any(statements, list_ids):
+    # Whether the statements hold a _Block whose list has one of the ids.
+    for statement in statements:
+        if isinstance(statement, _Block):
+            if id(statement._statements) in list_ids:
+                return True
+            if _contains_any(statement._statements, list_ids):
+                return True
+    return False
+
+
+def _is_private(name):
+    return name.startswith('__') and not name.endswith('__')
+
+
+class _ReturnPacker(ast.NodeTransformer):
+    # Rewrites the return statements of an outlined block, so that the caller
+    # can tell them apart from the end of the block.
+    def __init__(self, num_outputs):
+        self._padding = [ast.Constant(None)] * num_outputs
+
+    def visit_Return(self, node):
+        value = node.value or ast.Constant(None)
+        elts = [ast.Constant(True), value, *self._padding]
+        return ast.Return(ast.Tuple(elts, _LOAD))
+
+    def _skip(self, node):
+        return node
+
+    visit_FunctionDef = _skip
+    visit_AsyncFunctionDef = _skip
+    visit_ClassDef = _skip
+    visit_Lambda = _skip
 
 
 def _binop(a, op, b):
     assert isinstance(op, str)
-    return Code('(', Val(a), f' {op} ', Val(b), ')')
+    return _node('binop', '(', Val(a), f' {op} ', Val(b), ')')
+
+
+# The ast module's context and operator nodes carry no data, so the lowered
+# tree can share a single instance of each one, as ast.parse itself does.
+_BINARY_OPERATORS = {
+    '+': ast.Add(),
+    '-': ast.Sub(),
+    '*': ast.Mult(),
+    '@': ast.MatMult(),
+    '/': ast.Div(),
+    '//': ast.FloorDiv(),
+    '%': ast.Mod(),
+    '**': ast.Pow(),
+    '<<': ast.LShift(),
+    '>>': ast.RShift(),
+    '&': ast.BitAnd(),
+    '|': ast.BitOr(),
+    '^': ast.BitXor(),
+}
+
+_COMPARISON_OPERATORS = {
+    '==': ast.Eq(),
+    '!=': ast.NotEq(),
+    '<': ast.Lt(),
+    '<=': ast.LtE(),
+    '>': ast.Gt(),
+    '>=': ast.GtE(),
+    'is': ast.Is(),
+    'is not': ast.IsNot(),
+    'in': ast.In(),
+    'not in': ast.NotIn(),
+}
+
+_BOOLEAN_OPERATORS = {'and': ast.And(), 'or': ast.Or()}
+
+_UNARY_OPERATORS = {'-': ast.USub(), '+': ast.UAdd(), '~': ast.Invert()}
+
+_NOT = ast.Not()
+_LOAD = ast.Load()
+_STORE = ast.Store()
+
+_CONTINUATION_KEYWORDS = ('elif', 'else', 'except', 'finally')
+
+# The generated tree has no meaningful positions. Setting them up front is much
+# cheaper than running ast.fix_missing_locations over the finished module.
+_LOCATION = {'lineno': 1, 'col_offset': 0}
+
+
+def _lower_block(statements):
+    result = []
+
+    # The most recent compound statement, for attaching elif, else, etc.
+    previous = None
+
+    # The decorators for the next def or class.
+    decorators = []
+
+    index = 0
+    while index < len(statements):
+        statement = statements[index]
+        index += 1
+
+        if not isinstance(statement, Code):
+            if statement != '':
+                result.extend(ast.parse(str(statement)).body)
+                previous = None
+        elif statement._kind is None and repr(statement).startswith('@'):
+            decorators.append(_parse_expression(repr(statement)[1:]))
+        elif statement._kind in ('header', 'def', 'class'):
+            block = statements[index]
+            index += 1
+            body = _lower_block(block._statements) or [ast.Pass(**_LOCATION)]
+            node = _lower_header(statement, body, previous)
+            if statement._kind != 'header':
+                node.decorator_list, decorators = decorators, []
+            if statement._parts[0] not in _CONTINUATION_KEYWORDS:
+                result.append(node)
+            previous = node
+        elif statement._kind != 'comment':
+            result.extend(_lower_statement(statement))
+            previous = None
+
+    return result
+
+
+def _lower_header(header, body, previous):
+    kind, parts = header._kind, header._parts
+
+    if kind == 'def':
+        args = _shared_node(ast.arguments, parts[3])
+        return ast.FunctionDef(parts[1], args, body, [], None, **_LOCATION)
+
+    if kind == 'class':
+        node = ast.parse(f'{header!r} pass').body[0]
+        node.body = body
+        return node
+
+    keyword = parts[0]
+    condition = parts[2] if len(parts) == 4 else None
+
+    if keyword in ('if', 'while'):
+        node_type = ast.If if keyword == 'if' else ast.While
+        return node_type(_lower_expression(condition), body, [], **_LOCATION)
+
+    if keyword == 'elif' and isinstance(previous, ast.If):
+        node = ast.If(_lower_expression(condition), body, [], **_LOCATION)
+        previous.orelse = [node]
+        return node
+
+    if keyword == 'else' and isinstance(previous, (ast.If, ast.For, ast.While)):
+        previous.orelse = body
+        return previous
+
+    if keyword == 'for':
+        target, _, iterable = condition._parts
+        target = _store(_lower_expression(target))
+        return ast.For(target, _lower_expression(iterable), body, [], **_LOCATION)
+
+    if keyword == 'with':
+        if condition._kind == 'as':
+            value, _, name = condition._parts
+            value, name = _lower_expression(value), _lower_expression(name)
+            item = ast.withitem(value, _store(name))
+        else:
+            item = ast.withitem(_lower_expression(condition), None)
+        return ast.With([item], body, **_LOCATION)
+
+    if keyword == 'try':
+        return ast.Try(body, [], [], [], **_LOCATION)
+
+    if isinstance(previous, ast.Try):
+        if keyword == 'except':
+            if condition is None:
+                exc_type, name = None, None
+            elif condition._kind == 'as':
+                value, _, name = condition._parts
+                exc_type, name = _lower_expression(value), repr(name)
+            else:
+                exc_type, name = _lower_expression(condition), None
+            handler = ast.ExceptHandler(exc_type, name, body, **_LOCATION)
+            previous.handlers.append(handler)
+            return previous
+
+        if keyword == 'else':
+            previous.orelse = body
+            return previous
+
+        if keyword == 'finally':
+            previous.finalbody = body
+            return previous
+
+    raise SyntaxError(f'Unexpected {keyword!r} block')
+
+
+# The builder only reads the names of the parameters, so it can share the nodes.
+# Lowering gets parameters of its own from _shared_node.
+@functools.lru_cache(maxsize=1024)
+def _parse_parameters(params):
+    return ast.parse(f'def f({params}): pass').body[0].args
+
+
+def _lower_statement(statement):
+    kind, parts = statement._kind, statement._parts
+
+    if kind == 'assign':
+        target, _, value = parts
+        target = _store(_lower_expression(target))
+        return [ast.Assign([target], _lower_expression(value), **_LOCATION)]
+
+    if kind == 'keyword':
+        keyword = parts[0]
+        value = _lower_expression(parts[2]) if len(parts) == 3 else None
+        if keyword == 'return':
+            return [ast.Return(value, **_LOCATION)]
+        if keyword == 'yield':
+            return [ast.Expr(ast.Yield(value, **_LOCATION), **_LOCATION)]
+        if keyword == 'raise':
+            return [ast.Raise(value, None, **_LOCATION)]
+        if keyword == 'assert':
+            return [ast.Assert(value, None, **_LOCATION)]
+
+    if kind is None or kind == 'keyword':
+        # Opaque fragments can only be lowered by parsing their text.
+        return ast.parse(repr(statement)).body
+
+    return [ast.Expr(_lower_expression(statement), **_LOCATION)]
+
+
+def _lower_expression(expr):
+    lower = _EXPRESSION_LOWERINGS.get(expr._kind)
+    node = None if lower is None else lower(expr._parts)
+    if node is None:
+        # Opaque fragments can only be lowered by parsing their text.
+        node = _parse_expression(repr(expr))
+    return node
+
+
+def _parse_expression(text):
+    # The parentheses allow expressions like `yield x`, which can't stand on
+    # their own in eval mode. The newline ends a trailing comment.
+    return ast.parse(f'({text.strip()}\n)', mode='eval').body
+
+
+def _lower_name(parts):
+    if not keyword.iskeyword(parts[0]):
+        return _shared_node(ast.Name, parts[0])
+
+
+def _lower_literal(parts):
+    # Floats aren't shared, since -0.0 and 0.0 are equal keys.
+    value = parts[0]
+    if type(value) is str or type(value) is int:
+        return _shared_node(ast.Constant, value)
+    return ast.Constant(value, **_LOCATION)
+
+
+# Reading a name or a constant always lowers to the same node, and so do the
+# parameters of a def, so lowering reuses them. Compiling shared nodes works
+# fine. Each tree gets nodes of its own, and builds in other threads don't see
+# them.
+_lowering = threading.local()
+
+
+@contextmanager
+def _shared_nodes():
+    saved = getattr(_lowering, 'nodes', None)
+    _lowering.nodes = {}
+    try:
+        yield
+    finally:
+        _lowering.nodes = saved
+
+
+def _shared_node(node_type, key):
+    nodes = _lowering.nodes
+    node = nodes.get((node_type, key))
+    if node is None:
+        if node_type is ast.Name:
+            node = ast.Name(key, _LOAD, **_LOCATION)
+        elif node_type is ast.Constant:
+            node = ast.Constant(key, **_LOCATION)
+        else:
+            node = _parse_parameters.__wrapped__(key)
+        nodes[node_type, key] = node
+    return node
+
+
+def _lower_binop(parts):
+    _, left, op, right, _ = parts
+    op = op.strip()
+    if op in _BINARY_OPERATORS:
+        left, right = _lower_expression(left), _lower_expression(right)
+        return ast.BinOp(left, _BINARY_OPERATORS[op], right, **_LOCATION)
+    if op in _COMPARISON_OPERATORS:
+        left, right = _lower_expression(left), _lower_expression(right)
+        return ast.Compare(left, [_COMPARISON_OPERATORS[op]], [right], **_LOCATION)
+    if op in _BOOLEAN_OPERATORS:
+        values = [_lower_expression(left), _lower_expression(right)]
+        return ast.BoolOp(_BOOLEAN_OPERATORS[op], values, **_LOCATION)
+
+
+def _lower_unary(parts):
+    op = _UNARY_OPERATORS[parts[0][1:]]
+    return ast.UnaryOp(op, _lower_expression(parts[1]), **_LOCATION)
+
+
+def _lower_not(parts):
+    return ast.UnaryOp(_NOT, _lower_expression(parts[1]), **_LOCATION)
+
+
+def _lower_call(parts):
+    args, keywords = [], []
+    index = 2
+    while index < len(parts) - 1:
+        part = parts[index]
+        if isinstance(part, Code):
+            args.append(_lower_expression(part))
+            index += 2
+        else:
+            value = _lower_expression(parts[index + 2])
+            keywords.append(ast.keyword(part, value, **_LOCATION))
+            index += 4
+    return ast.Call(_lower_expression(parts[0]), args, keywords, **_LOCATION)
+
+
+def _lower_attribute(parts):
+    obj, _, name = parts
+    return ast.Attribute(_lower_expression(obj), name, _LOAD, **_LOCATION)
+
+
+def _lower_subscript(parts):
+    obj, key = _lower_expression(parts[0]), _lower_expression(parts[2])
+    return ast.Subscript(obj, key, _LOAD, **_LOCATION)
+
+
+def _lower_yield(parts):
+    return ast.Yield(_lower_expression(parts[1]), **_LOCATION)
+
+
+def _lower_tuple(parts):
+    elts = [_lower_expression(x) for x in parts[1::2]]
+    return ast.Tuple(elts, _LOAD, **_LOCATION)
+
+
+def _lower_list(parts):
+    elts = [_lower_expression(x) for x in parts[1::2]]
+    return ast.List(elts, _LOAD, **_LOCATION)
+
+
+def _lower_set(parts):
+    elts = [_lower_expression(x) for x in parts[1::2]]
+    return ast.Set(elts, **_LOCATION)
+
+
+def _lower_dict(parts):
+    items = [item._parts for item in parts[1::2]]
+    keys = [_lower_expression(key) for key, _, _ in items]
+    values = [_lower_expression(value) for _, _, value in items]
+    return ast.Dict(keys, values, **_LOCATION)
+
+
+_EXPRESSION_LOWERINGS = {
+    'name': _lower_name,
+    'literal': _lower_literal,
+    'binop': _lower_binop,
+    'unary': _lower_unary,
+    'not': _lower_not,
+    'call': _lower_call,
+    'attribute': _lower_attribute,
+    'subscript': _lower_subscript,
+    'yield': _lower_yield,
+    'tuple': _lower_tuple,
+    'list': _lower_list,
+    'set': _lower_set,
+    'dict': _lower_dict,
+}
+
+
+def _store(node):
+    if isinstance(node, ast.Name):
+        return ast.Name(node.id, _STORE, **_LOCATION)
+    if isinstance(node, ast.Attribute):
+        return ast.Attribute(node.value, node.attr, _STORE, **_LOCATION)
+    if isinstance(node, ast.Subscript):
+        return ast.Subscript(node.value, node.slice, _STORE, **_LOCATION)
+    if isinstance(node, ast.Starred):
+        return ast.Starred(_store(node.value), _STORE, **_LOCATION)
+    if isinstance(node, (ast.Tuple, ast.List)):
+        elts = [_store(elt) for elt in node.elts]
+        return type(node)(elts, _STORE, **_LOCATION)
+    return node
+
+
+_FOLDABLE_OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '//': operator.floordiv,
+    '%': operator.mod,
+    '**': operator.pow,
+    '<<': operator.lshift,
+    '>>': operator.rshift,
+    '&': operator.and_,
+    '|': operator.or_,
+    '^': operator.xor,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+}
+
+_FOLDABLE_UNARY_OPERATORS = {
+    '-': operator.neg,
+    '+': operator.pos,
+    '~': operator.invert,
+}
+
+# Ordering comparisons don't have exact negations, because of values like NaN.
+_NEGATED_COMPARISONS = {
+    '==': '!=',
+    '!=': '==',
+    'in': 'not in',
+    'not in': 'in',
+    'is': 'is not',
+    'is not': 'is',
+}
+
+# Like CPython's own optimizer, don't fold values that take a lot of space.
+_MAX_FOLDED_SIZE = 4096
+
+
+def _fold_block(statements, memo, names=None):
+    # Fold the constant expressions in a list of statements, and drop the
+    # branches of if statements whose conditions are known. The memo maps the
+    # ids of the original fragments to their folded versions. In a function,
+    # names collects the names that the dropped branches bound.
+    result = []
+    chain = None
+    index = 0
+    while index < len(statements):
+        statement = statements[index]
+        index += 1
+
+        if isinstance(statement, _Block):
+            header = result[-1] if result else None
+            block_names = _block_names(header, names)
+            body = _fold_body(statement._statements, memo, block_names)
+            if block_names and block_names is not names:
+                body = _keep_names(body, block_names)
+            result.append(_Block(body))
+            chain = None
+            continue
+
+        if not isinstance(statement, Code) or _is_trivia(statement):
+            result.append(statement)
+            continue
+
+        statement = _fold_expression(statement, memo)
+        # When streaming, a header can show up without its block.
+        keyword = None
+        has_block = index < len(statements) and isinstance(statements[index], _Block)
+        if statement._kind == 'header' and has_block:
+            keyword = statement._parts[0]
+
+        if keyword == 'if':
+            # Track whether the chain has an if clause in the output yet, and
+            # whether one of its conditions is known to be true. The stubs for
+            # the dropped clauses go before the chain, so they don't split it.
+            chain = [False, False, len(result)]
+        elif keyword not in ('elif', 'else') or chain is None:
+            result.append(statement)
+            chain = None
+            continue
+
+        block = statements[index]
+        index += 1
+
+        if keyword == 'else':
+            known, value = True, True
+        else:
+            known, value = _constant(statement._parts[2])
+
+        if chain[1] or (known and not value):
+            if names is not None:
+                result[chain[2] : chain[2]] = _dropped_stub(block._statements, names)
+        elif not known:
+            if not chain[0]:
+                statement = _node('header', 'if', *statement._parts[1:])
+            result.append(statement)
+            result.append(_Block(_fold_body(block._statements, memo, names)))
+            chain[0] = True
+        else:
+            chain[1] = True
+            body = _fold_body(block._statements, memo, names)
+            if chain[0]:
+                result.append(_node('header', 'else', ':'))
+                result.append(_Block(body))
+            else:
+                result.extend(body)
+
+    return result
+
+
+def _block_names(header, names):
+    # A function starts a new set of names, and the names in a class body don't
+    # belong to any function.
+    if isinstance(header, Code) and header._kind == 'def':
+        return set()
+    if isinstance(header, Code) and header._kind == 'class':
+        return None
+    return names
+
+
+def _dropped_stub(statements, names):
+    # Code that never runs still decides what its function is: a yield makes it
+    # a generator, and declarations and bindings decide the scopes of names.
+    # Return a stub that never runs, with the yields, awaits and declarations of
+    # the statements, and add the names that they bind to names.
+    writer = _Writer()
+    for statement in statements:
+        writer.write_line(statement)
+    try:
+        tree = ast.parse(writer.getvalue())
+    except SyntaxError:
+        return [_node('header', 'if', ' ', Val(False), ':'), _Block(statements)]
+
+    stub, declared = [], set()
+    found = set()
+    stack = list(tree.body)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.Global, ast.Nonlocal)):
+            keyword = 'global' if isinstance(node, ast.Global) else 'nonlocal'
+            stub.append(Code(f'{keyword} {", ".join(node.names)}'))
+            declared.update(node.names)
+        elif isinstance(node, (ast.Yield, ast.YieldFrom)):
+            found.add('yield')
+        elif isinstance(node, ast.Await):
+            found.add('await None')
+        elif isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.partition('.')[0])
+        if isinstance(node, _NESTED_SCOPES):
+            if not isinstance(node, ast.expr):
+                names.add(node.name)
+            continue
+        stack.extend(ast.iter_child_nodes(node))
+
+    names -= declared
+    stub.extend(Code(x) for x in sorted(found))
+    if not stub:
+        return []
+    return [_node('header', 'if', ' ', Val(False), ':'), _Block(stub)]
+
+
+def _keep_names(body, names):
+    # Keep the names that only dead code bound as locals of the function.
+    writer = _Writer()
+    for statement in body:
+        writer.write_line(statement)
+    with suppress(SyntaxError):
+        names = names - _scan_block(ast.parse(writer.getvalue()).body)[1]
+    if not names:
+        return body
+    start = 1 if body and _is_docstring(body[0]) else 0
+    binding = Code(f'{" = ".join(sorted(names))} = None')
+    stub = [_node('header', 'if', ' ', Val(False), ':'), _Block([binding])]
+    return body[:start] + stub + body[start:]
+
+
+def _prune_block(statements, allocated, complete=True, names=None):
+    # Drop the statements that follow a return, raise, break or continue, and
+    # the trailing clauses of if statements that do nothing, as long as their
+    # conditions have no side effects. In functions, also drop assignments to
+    # the builder's variables that nothing reads. In a function, names collects
+    # the names that the dropped statements bound.
+    result = []
+    index = 0
+    while index < len(statements):
+        statement = statements[index]
+        index += 1
+        if isinstance(statement, _Block):
+            body = _prune_body(statement._statements, allocated, names)
+            result.append(_Block(body))
+            continue
+
+        if index >= len(statements) or not isinstance(statements[index], _Block):
+            result.append(statement)
+            if _ends_block(statement):
+                if names is not None:
+                    result.extend(_dropped_stub(statements[index:], names))
+                break
+            continue
+
+        block = statements[index]
+        index += 1
+        block_names = _block_names(statement, names)
+        body = _prune_body(block._statements, allocated, block_names)
+        if isinstance(statement, Code) and statement._kind == 'def':
+            body = _drop_dead_assignments(body, allocated)
+        if block_names and block_names is not names:
+            body = _keep_names(body, block_names)
+        result.append(statement)
+        result.append(_Block(body))
+
+        next_index = index
+        while next_index < len(statements) and _is_trivia(statements[next_index]):
+            next_index += 1
+        if next_index < len(statements):
+            if _continues_statement(statements[next_index]):
+                continue
+        elif not complete:
+            continue
+        _drop_empty_clauses(result)
+
+    return result
+
+
+def _prune_body(statements, allocated, names=None):
+    result = _prune_block(statements, allocated, names=names)
+    if all(_is_trivia(x) for x in result):
+        result.append('pass')
+    return result
+
+
+def _ends_block(statement):
+    if isinstance(statement, Code):
+        if statement._kind == 'keyword':
+            return statement._parts[0] in ('return', 'raise')
+        if statement._kind is not None:
+            return False
+        statement = repr(statement)
+    return isinstance(statement, str) and statement in ('break', 'continue')
+
+
+def _drop_empty_clauses(result):
+    while len(result) >= 2 and isinstance(result[-1], _Block):
+        header, block = result[-2:]
+        if not isinstance(header, Code) or header._kind != 'header':
+            return
+        if not _is_empty(block._statements):
+            return
+        keyword = header._parts[0]
+        if keyword == 'if' or keyword == 'elif':
+            if not _is_pure(header._parts[2]):
+                return
+        elif keyword != 'else':
+            return
+        del result[-2:]
+        if keyword == 'if':
+            return
+
+
+def _is_empty(statements):
+    return all(
+        _is_trivia(x) or (isinstance(x, str) and x == 'pass') for x in statements
+    )
+
+
+_READ_KINDS = frozenset(
+    [
+        'name',
+        'literal',
+        'binop',
+        'unary',
+        'not',
+        'attribute',
+        'subscript',
+        'tuple',
+        'list',
+        'set',
+        'dict',
+    ]
+)
+
+_PURE_KINDS = frozenset(['name', 'literal', 'tuple', 'list'])
+
+
+def _is_read_only(expr):
+    # Check whether an expression is made only of reads and operators. Calls,
+    # yields and opaque fragments might have side effects.
+    return _has_only_kinds(expr, _READ_KINDS)
+
+
+def _is_pure(expr):
+    # Check whether an expression can be dropped. Besides calls, operators,
+    # attributes and subscripts can raise an exception that the code relies on,
+    # so only names, literals and tuples and lists of them are safe.
+    return _has_only_kinds(expr, _PURE_KINDS)
+
+
+def _has_only_kinds(expr, kinds):
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, Code):
+            continue
+        if node._kind not in kinds:
+            return False
+        if node._kind != 'literal':
+            stack.extend(node._parts)
+    return True
+
+
+def _drop_dead_assignments(statements, allocated):
+    # Drop the assignments to the builder's variables that nothing in the
+    # function reads. An assignment whose value might have side effects or raise
+    # an exception becomes an expression statement. Dropping one can leave
+    # others unread, so repeat until nothing changes.
+    while True:
+        writer = _Writer()
+        for statement in statements:
+            writer.write_line(statement)
+        try:
+            tree = ast.parse(writer.getvalue())
+        except SyntaxError:
+            return statements
+
+        reads = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                reads.add(node.id)
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                reads.update(node.names)
+
+        statements, changed = _drop_unread(statements, allocated, reads)
+        if not changed:
+            return statements
+
+
+def _drop_unread(statements, allocated, reads):
+    # Drop the assignments to the builder's variables that aren't in reads.
+    # Return the statements, and whether any changed.
+    result = []
+    changed = False
+    for statement in statements:
+        if isinstance(statement, _Block):
+            body, body_changed = _drop_unread(statement._statements, allocated, reads)
+            changed = changed or body_changed
+            if all(_is_trivia(x) for x in body):
+                body.append('pass')
+            statement = _Block(body)
+        elif isinstance(statement, Code) and statement._kind == 'assign':
+            target, _, value = statement._parts
+            name = target._parts[0] if target._kind == 'name' else None
+            if name in allocated and name not in reads:
+                changed = True
+                if _is_pure(value):
+                    continue
+                statement = value
+        result.append(statement)
+    return result, changed
+
+
+def _peephole_block(statements, rules, fusable):
+    # Offer each pair of adjacent simple statements to the rules. The first
+    # rule that returns a list of statements replaces the pair, and the last
+    # statement of the replacement pairs up with the next statement. Also fuse
+    # adjacent if statements that were marked as safe to fuse.
+    result = []
+    for statement in statements:
+        if isinstance(statement, _Block):
+            body = _peephole_block(statement._statements, rules, fusable)
+            block = _Block(body)
+            if id(statement) in fusable:
+                # Keep the new blocks in the table, so that their ids stay
+                # unique while the pass runs.
+                fusable[id(block)] = block
+                if _can_fuse(result, fusable):
+                    body = result[-2]._statements + body
+                    block = _Block(_peephole_block(body, rules, fusable))
+                    fusable[id(block)] = block
+                    del result[-3:-1]
+            result.append(block)
+            continue
+
+        if result and _is_simple(statement) and _is_simple(result[-1]):
+            for rule in rules:
+                replacement = rule(result[-1], statement)
+                if replacement is not None:
+                    result[-1:] = replacement
+                    break
+            else:
+                result.append(statement)
+        else:
+            result.append(statement)
+    return result
+
+
+def _can_fuse(result, fusable):
+    # Check for two if statements in a row at the end of the result, with the
+    # second one still missing its block.
+    if len(result) < 3 or id(result[-2]) not in fusable:
+        return False
+    first, second = result[-3], result[-1]
+    return (
+        isinstance(first, Code)
+        and first._kind == 'header'
+        and first._parts[0] == 'if'
+        and second._kind == 'header'
+        and second._parts[0] == 'if'
+        and repr(first._parts[2]) == repr(second._parts[2])
+    )
+
+
+def _is_simple(statement):
+    return isinstance(statement, Code) and statement._kind not in (
+        'header',
+        'def',
+        'class',
+        'comment',
+    )
+
+
+def merge_literal_appends(first, second):
+    # Turn `out.append('a')` followed by `out.append('b')` into
+    # `out.extend(['a', 'b'])`.
+    a, b = _literal_appends(first), _literal_appends(second)
+    if a is None or b is None or repr(a[0]) != repr(b[0]):
+        return None
+    items = _separated([*a[1], *b[1]], ', ')
+    return [a[0].extend(_node('list', '[', *items, ']'))]
+
+
+def _literal_appends(statement):
+    # Return the target and the items of an append or extend call whose
+    # arguments are literals.
+    if statement._kind != 'call' or len(statement._parts) != 4:
+        return None
+    callee, _, arg, _ = statement._parts
+    if not isinstance(callee, Code) or callee._kind != 'attribute':
+        return None
+    target, _, method = callee._parts
+    if not isinstance(target, Code) or not _is_read_only(target):
+        return None
+    if method == 'append' and arg._kind == 'literal':
+        return target, [arg]
+    if method == 'extend' and arg._kind == 'list':
+        items = arg._parts[1:-1:2]
+        if all(x._kind == 'literal' for x in items):
+            return target, items
+    return None
+
+
+def combine_increments(first, second):
+    # Turn `x = x + 1` followed by `x = x + 2` into `x = x + 3`, for integer
+    # increments and decrements. Only use this rule when every target holds an
+    # int, since float rounding can make the two versions differ.
+    a, b = _increment(first), _increment(second)
+    if a is None or b is None or repr(a[0]) != repr(b[0]):
+        return None
+    target, total = a[0], a[1] + b[1]
+    if total < 0:
+        return [target << _binop(target, '-', -total)]
+    return [target << _binop(target, '+', total)]
+
+
+def _increment(statement):
+    if statement._kind != 'assign':
+        return None
+    target, _, value = statement._parts
+    if not _is_read_only(target) or value._kind != 'binop':
+        return None
+    _, left, op, right, _ = value._parts
+    if op not in (' + ', ' - ') or repr(left) != repr(target):
+        return None
+    known, amount = _constant(right)
+    if not known or type(amount) is not int:
+        return None
+    return target, amount if op == ' + ' else -amount
+
+
+def _fold_body(statements, memo, names=None):
+    result = _fold_block(statements, memo, names)
+    if all(_is_trivia(x) for x in result):
+        result.append('pass')
+    return result
+
+
+def _fold_expression(expr, memo):
+    stack = [expr]
+    while stack:
+        node = stack[-1]
+        if id(node) in memo:
+            stack.pop()
+            continue
+
+        pending = [
+            part
+            for part in node._parts
+            if isinstance(part, Code) and id(part) not in memo
+        ]
+        if pending:
+            stack.extend(pending)
+            continue
+
+        stack.pop()
+        parts = tuple(
+            memo[id(part)] if isinstance(part, Code) else part for part in node._parts
+        )
+        result = _fold_node(node._kind, parts)
+        if result is None:
+            if any(a is not b for a, b in zip(parts, node._parts)):
+                result = _node(node._kind, *parts)
+            else:
+                result = node
+        memo[id(node)] = result
+
+    return memo[id(expr)]
+
+
+def _fold_node(kind, parts):
+    if kind == 'binop':
+        _, left, op, right, _ = parts
+        op = op.strip()
+        known, a = _constant(left)
+        if op == 'and' or op == 'or':
+            if known:
+                return left if bool(a) == (op == 'or') else right
+            return None
+
+        known_right, b = _constant(right)
+        foldable = known and known_right and op in _FOLDABLE_OPERATORS
+        if foldable and _is_small_enough(op, a, b):
+            with suppress(ArithmeticError, TypeError, ValueError):
+                return _constant_node(_FOLDABLE_OPERATORS[op](a, b))
+
+    elif kind == 'unary':
+        known, value = _constant(parts[1])
+        if known:
+            with suppress(ArithmeticError, TypeError):
+                return _constant_node(_FOLDABLE_UNARY_OPERATORS[parts[0][1:]](value))
+
+    elif kind == 'not':
+        operand = parts[1]
+        known, value = _constant(operand)
+        if known:
+            return Val(not value)
+        if operand._kind == 'binop':
+            _, left, op, right, _ = operand._parts
+            negated = _NEGATED_COMPARISONS.get(op.strip())
+            if negated is not None:
+                return _binop(left, negated, right)
+
+    return None
+
+
+def _constant(expr):
+    # Return (True, value) if the fragment is a known constant. Negative numbers
+    # show up as a minus sign applied to a literal.
+    if not isinstance(expr, Code):
+        return False, None
+    if expr._kind == 'literal':
+        return True, expr._parts[0]
+    if expr._kind == 'unary' and expr._parts[0] == '(-':
+        operand = expr._parts[1]
+        if operand._kind == 'literal' and type(operand._parts[0]) in (int, float):
+            return True, -operand._parts[0]
+    return False, None
+
+
+def _constant_node(value):
+    kind = type(value)
+    if kind not in _LITERAL_TYPES or (kind is float and not math.isfinite(value)):
+        return None
+    if kind in (str, bytes) and len(value) > _MAX_FOLDED_SIZE:
+        return None
+    if kind is int and value.bit_length() > _MAX_FOLDED_SIZE:
+        return None
+
+    # Keep negative numbers in parentheses, so that they can't bind to a
+    # neighbouring operator, as in (-2) ** 2.
+    if kind in (int, float) and (value < 0 or math.copysign(1, value) < 0):
+        return _node('unary', '(-', Val(-value), ')')
+    return Val(value)
+
+
+def _is_small_enough(op, a, b):
+    # Check the size of the result before computing it, for operators whose
+    # results can be huge.
+    if op == '**' and type(a) is int and type(b) is int and b > 0:
+        return a.bit_length() * b <= _MAX_FOLDED_SIZE
+    if op == '<<' and type(a) is int and type(b) is int:
+        return a.bit_length() + b <= _MAX_FOLDED_SIZE
+    if op == '*' and isinstance(b, (str, bytes)):
+        a, b = b, a
+    if op == '*' and isinstance(a, (str, bytes)) and type(b) is int:
+        return len(a) * b <= _MAX_FOLDED_SIZE
+    return True
+
+
+# Markers for the writer's work stack. A _LINE marker means that the next item
+# on the stack is a whole statement, and _DEDENT closes an indented block. An
+# _END marker follows a fragment's parts, and it sits on top of the fragment,
+# the index of its first chunk and the output size when it started.
+_LINE = object()
+_DEDENT = object()
+_END = object()
+
+# An _OPERAND marker sits on top of a fragment and the precedence that the
+# fragment needs in order to go without parentheses.
+_OPERAND = object()
+
+# Precedence levels for rendering with minimal parentheses, from the lowest.
+_OPERATOR_PRECEDENCE = {
+    ' or ': 1,
+    ' and ': 2,
+    ' == ': 4,
+    ' != ': 4,
+    ' < ': 4,
+    ' <= ': 4,
+    ' > ': 4,
+    ' >= ': 4,
+    ' is ': 4,
+    ' is not ': 4,
+    ' in ': 4,
+    ' not in ': 4,
+    ' | ': 5,
+    ' ^ ': 6,
+    ' & ': 7,
+    ' << ': 8,
+    ' >> ': 8,
+    ' + ': 9,
+    ' - ': 9,
+    ' * ': 10,
+    ' @ ': 10,
+    ' / ': 10,
+    ' // ': 10,
+    ' % ': 10,
+    ' ** ': 12,
+}
+_NOT_PRECEDENCE = 3
+_COMPARISON_PRECEDENCE = 4
+_UNARY_PRECEDENCE = 11
+_POWER_PRECEDENCE = 12
+_PRIMARY_PRECEDENCE = 14
+_ATOM_PRECEDENCE = 15
+
+# The parts of these kinds of fragments can go anywhere that an expression can.
+_OPEN_KINDS = frozenset(
+    ['assign', 'keyword', 'header', 'in', 'as', 'tuple', 'list', 'set', 'dict']
+)
+
+
+def _precedence(expr):
+    kind = expr._kind
+    if kind == 'binop':
+        # Unknown operators keep their parentheses.
+        return _OPERATOR_PRECEDENCE.get(expr._parts[2], _ATOM_PRECEDENCE)
+    if kind == 'unary':
+        return _UNARY_PRECEDENCE
+    if kind == 'not':
+        return _NOT_PRECEDENCE
+    if kind == 'literal' and type(expr._parts[0]) in (int, float):
+        # A negative number is really a minus sign, and an integer can't be
+        # followed by a dot.
+        if repr(expr._parts[0]).startswith('-'):
+            return _UNARY_PRECEDENCE
+        if type(expr._parts[0]) is int:
+            return _PRIMARY_PRECEDENCE - 1
+    return _ATOM_PRECEDENCE
+
+
+def _push_minimal(item, push):
+    # Push the parts of a fragment for the writer, leaving out its own
+    # parentheses, and marking each operand with the precedence it needs.
+    kind, parts = item._kind, item._parts
+
+    if kind == 'binop':
+        _, left, op, right, _ = parts
+        precedence = _OPERATOR_PRECEDENCE.get(op)
+        if precedence is None:
+            push(')')
+            _push_operand(right, _ATOM_PRECEDENCE, push)
+            push(op)
+            _push_operand(left, _ATOM_PRECEDENCE, push)
+            push('(')
+        elif precedence == _POWER_PRECEDENCE:
+            _push_operand(right, _UNARY_PRECEDENCE, push)
+            push(op)
+            _push_operand(left, precedence + 1, push)
+        elif precedence <= _COMPARISON_PRECEDENCE:
+            # Comparisons chain, and the boolean operators flatten, so keep
+            # the parentheses around nested ones.
+            _push_operand(right, precedence + 1, push)
+            push(op)
+            _push_operand(left, precedence + 1, push)
+        else:
+            _push_operand(right, precedence + 1, push)
+            push(op)
+            _push_operand(left, precedence, push)
+
+    elif kind == 'unary':
+        _push_operand(parts[1], _UNARY_PRECEDENCE, push)
+        push(parts[0][1:])
+
+    elif kind == 'not':
+        _push_operand(parts[1], _NOT_PRECEDENCE, push)
+        push('not ')
+
+    elif kind in ('attribute', 'subscript', 'call'):
+        for part in reversed(parts[1:]):
+            push(part)
+        _push_operand(parts[0], _PRIMARY_PRECEDENCE, push)
+
+    elif kind in _OPEN_KINDS:
+        for part in reversed(parts):
+            push(part)
+
+    else:
+        # Opaque text could put anything next to a part, so give every part
+        # its parentheses.
+        for part in reversed(parts):
+            if isinstance(part, Code):
+                _push_operand(part, _ATOM_PRECEDENCE, push)
+            else:
+                push(part)
+
+
+def _push_operand(operand, precedence, push):
+    push(operand)
+    push(precedence)
+    push(_OPERAND)
 
 
 class _Writer:
-    def __init__(self):
+    def __init__(self, cache_limit=1024, minimal_parens=False, line_map=False):
         self._indent = 0
-        self._out = io.StringIO()
+        self._chunks = []
+        self._cache_limit = cache_limit
+        self._minimal_parens = minimal_parens
+
+        # With a line map, the writer records the chunk where each statement
+        # starts, and works out the line numbers at the end.
+        self._starts = [] if line_map else None
 
     def getvalue(self):
-        return self._out.getvalue()
+        return ''.join(self._chunks)
 
-    @contextmanager
-    def indented(self):
-        was = self._indent
-        self._indent += 1
-        try:
-            yield
-        finally:
-            self._indent = was
+    def take(self):
+        result = self.getvalue()
+        self._chunks.clear()
+        return result
 
     def write_line(self, obj):
-        if isinstance(obj, _Block):
-            obj._write_block(self)
-        elif isinstance(obj, str) and obj == '':
-            self.write('\n')
-        else:
-            self.write('    ' * self._indent)
-            self.write(obj)
-            self.write('\n')
+        self._render([obj, _LINE])
+
+    def line_starts(self):
+        # Return the line number where each statement starts, along with the
+        # statement.
+        result, line, position = [], 1, 0
+        chunks = self._chunks
+        for index, statement in self._starts:
+            line += sum(chunk.count('\n') for chunk in chunks[position:index])
+            position = index
+            result.append((line, statement))
+        return result
 
     def write(self, obj):
-        if hasattr(obj, '_write'):
-            obj._write(self)
-        else:
-            self._out.write(str(obj))
+        self._render([obj])
+
+    def _render(self, stack):
+        # Walk the tree with an explicit stack instead of recursion, so that
+        # the depth of a tree is only limited by memory.
+        chunks = self._chunks
+        write = chunks.append
+        pop, push, extend = stack.pop, stack.append, stack.extend
+
+        # Fragments never change, so each one caches its rendered text, as long
+        # as the text isn't longer than the cache limit. With minimal
+        # parentheses, a fragment caches its text without its own parentheses,
+        # which only depend on where the fragment appears.
+        limit = self._cache_limit
+        minimal = self._minimal_parens
+        starts = self._starts
+        size = 0
+
+        while stack:
+            item = pop()
+
+            if type(item) is str:
+                write(item)
+                size += len(item)
+
+            elif isinstance(item, Code):
+                kind = item._kind
+                if kind == 'literal':
+                    text = item._text
+                    if text is None:
+                        text = repr(item._parts[0])
+                        if len(text) <= limit:
+                            item._text = text
+                else:
+                    text = item._bare_text if minimal else item._text
+
+                if text is None:
+                    push(item)
+                    push(len(chunks))
+                    push(size)
+                    push(_END)
+                    if minimal:
+                        _push_minimal(item, push)
+                    else:
+                        extend(reversed(item._parts))
+                else:
+                    write(text)
+                    size += len(text)
+
+            elif item is _OPERAND:
+                required = pop()
+                operand = pop()
+                if isinstance(operand, Code) and _precedence(operand) < required:
+                    push(')')
+                    push(operand)
+                    push('(')
+                else:
+                    push(operand)
+
+            elif item is _END:
+                start_size, start, fragment = pop(), pop(), pop()
+                if size - start_size <= limit:
+                    text = ''.join(chunks[start:])
+                    del chunks[start:]
+                    write(text)
+                    if minimal:
+                        fragment._bare_text = text
+                    else:
+                        fragment._text = text
+
+            elif item is _LINE:
+                statement = pop()
+                if isinstance(statement, _Block):
+                    self._indent += 1
+                    push(_DEDENT)
+                    for child in reversed(statement._statements):
+                        push(child)
+                        push(_LINE)
+                elif isinstance(statement, str) and statement == '':
+                    write('\n')
+                else:
+                    if starts is not None:
+                        starts.append((len(chunks), statement))
+                    push('\n')
+                    push(statement)
+                    push('    ' * self._indent)
+
+            elif item is _DEDENT:
+                self._indent -= 1
+
+            else:
+                text = str(item)
+                write(text)
+                size += len(text)
 
 
 class _SymbolFactory:
@@ -416,7 +3820,7 @@ class _SymbolFactory:
         return Code(*a, **k)
 
     def __getattr__(self, name):
-        return Code(name)
+        return _interned(_interned_names, name, 'name', name)
 
 
 sym = _SymbolFactory()
@@ -1,7 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
+import ast
+import cProfile
+import importlib
+import io
+import os
+import pickle
+import pstats
+import random
+import sys
 from textwrap import dedent
 
-from outsourcer import Code, CodeBuilder, Yield, sym
+from outsourcer import (
+    Code,
+    CodeBuilder,
+    DiskCache,
+    MemoryCache,
+    Val,
+    Yield,
+    _binop,
+    combine_increments,
+    compile_many,
+    load_profile,
+    merge_literal_appends,
+    read_profile,
+    reset_profile,
+    save_profile,
+    structure_key,
+    sym,
+)
 
 import pytest
 
@@ -371,3 +398,1311 @@ def test_global_section():
 def test_yield_expression():
     expr = sym.foo << Yield(sym.bar(1, 2, 3))
     assert _render(expr) == 'foo = (yield bar(1, 2, 3))'
+
+
+def test_disk_cache(tmp_path, monkeypatch):
+    b = CodeBuilder()
+    b += sym.answer << 42
+    cache = DiskCache(tmp_path)
+
+    first = b.compile(cache=cache)
+    assert first.answer == 42
+    assert len(list(tmp_path.glob('*.marshal'))) == 1
+
+    # A second compile of the same source should not call compile() at all.
+    def fail(*args, **kwargs):
+        raise AssertionError('compile() was called')
+
+    monkeypatch.setattr('builtins.compile', fail)
+    second = b.compile(cache=cache)
+    assert second.answer == 42
+
+
+def test_disk_cache_eviction(tmp_path):
+    cache = DiskCache(tmp_path, max_size=1)
+    for i in range(3):
+        b = CodeBuilder()
+        b += sym.answer << i
+        assert b.compile(cache=cache).answer == i
+
+    # Every entry is bigger than the limit, so nothing is kept around.
+    assert list(tmp_path.glob('*.marshal')) == []
+    assert list(tmp_path.glob('*.tmp')) == []
+
+
+def test_memory_cache():
+    cache = MemoryCache(max_size=2)
+
+    def build(value):
+        b = CodeBuilder()
+        b += sym.answer << value
+        return b.compile(cache=cache).answer
+
+    assert [build(1), build(1), build(2), build(3), build(1)] == [1, 1, 2, 3, 1]
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 4, 2)
+    assert len(cache) == 2
+
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses, cache.evictions) == (0, 0, 0)
+
+
+def _build_sample_program(b):
+    fiz, items, total = sym.fiz, sym.items, sym.total
+
+    b.add_docstring('A sample module.')
+    b.add_comment('Some helpers.')
+    with b.CLASS('Box', superclass='object'), b.DEF('__init__', ['self', 'value=0']):
+        b += sym.self.value << sym.value
+
+    with b.DEF('classify', ['items', '*extra', 'scale=1']):
+        b += total << 0
+        pairs = b.var('pairs', [])
+        with b.FOR((sym.index, sym.item), in_=sym.enumerate(items, start=1)):
+            with b.IF(sym.item % 3 == 0):
+                b += total << total + sym.item * sym.scale
+            with b.ELIF_NOT(sym.item % 2):
+                b += total << total - -sym.item
+            with b.ELSE():
+                b += pairs.append((sym.index, ~sym.item))
+        with b.ELSE():
+            b += fiz << sym.Box(total).value
+
+        with b.WHILE(total > 100):
+            b += total << total // 2
+
+        with b.TRY():
+            b += sym.extra[0]
+        with b.EXCEPT(sym.IndexError, as_='exc'):
+            b += fiz << sym.str(sym.exc)
+        with b.ELSE():
+            b += fiz << None
+        with b.FINALLY():
+            b.ASSERT(total >= 0)
+
+        with b.WITH(sym.open('/dev/null'), as_='f'):
+            b += sym.f.read()
+
+        b += fiz << {'fiz': fiz, 'head': items[: sym.scale]}
+        b.RETURN((total, pairs, fiz))
+
+    with b.DEF('count', ['n']):
+        with b.IF_NOT(sym.n > 0):
+            b.RAISE(sym.ValueError('n'))
+        with b.FOR(sym.i, in_=sym.range(sym.n)):
+            b.YIELD(sym.i**2)
+
+
+def test_ast_mode():
+    text_builder = CodeBuilder()
+    ast_builder = CodeBuilder(use_ast=True)
+    _build_sample_program(text_builder)
+    _build_sample_program(ast_builder)
+
+    expected = text_builder.compile()
+    actual = ast_builder.compile(source_var='_source_code')
+
+    for args in [[1, 2, 3, 4, 5, 6], [], [300, 301]]:
+        assert actual.classify(args) == expected.classify(args)
+    assert actual.classify([3], 'x', scale=2) == expected.classify([3], 'x', scale=2)
+    assert list(actual.count(4)) == list(expected.count(4)) == [0, 1, 4, 9]
+    assert actual.Box(5).value == 5
+
+    # The source code comes from ast.unparse, and it should compile.
+    assert actual._source_code == ast_builder.source_code()
+    assert 'def classify(items, *extra, scale=1):' in actual._source_code
+    compile(actual._source_code, '<test>', 'exec')
+
+    # Decorators go with the def after them, and opaque fragments can hold any
+    # expression.
+    for use_ast in [False, True]:
+        b = CodeBuilder(use_ast=use_ast)
+        b += 'import functools'
+        b += '@functools.lru_cache()'
+        with b.DEF('square', ['x']):
+            b.RETURN(sym.x * sym.x)
+        with b.DEF('echo', []):
+            b += sym.received << Code('yield 1')
+            b.RETURN(sym.received)
+        b += sym.zeros << (0.0, -0.0, 0)
+
+        module = b.compile()
+        assert module.square(3) == 9
+        assert module.square.cache_info().currsize == 1
+        generator = module.echo()
+        assert next(generator) == 1
+        with pytest.raises(StopIteration) as info:
+            generator.send('x')
+        assert info.value.value == 'x'
+        assert repr(module.zeros) == '(0.0, -0.0, 0)'
+
+    # Trees don't share nodes, even when they come from threads that run at the
+    # same time, so changing one tree leaves the others alone.
+    def lower(_):
+        return ast_builder.syntax_tree()
+
+    with ThreadPoolExecutor(4) as executor:
+        trees = list(executor.map(lower, range(8)))
+    kinds = (ast.stmt, ast.expr, ast.arguments, ast.arg)
+    nodes = [{id(x) for x in ast.walk(tree) if isinstance(x, kinds)} for tree in trees]
+    assert all(nodes[0].isdisjoint(x) for x in nodes[1:])
+    for node in ast.walk(trees[0]):
+        if isinstance(node, ast.Name):
+            node.id = 'changed'
+    assert ast_builder.compile().classify([3], 'x', scale=2) == expected.classify(
+        [3], 'x', scale=2
+    )
+
+
+def test_deeply_nested_expressions():
+    expr = sym.x0
+    for i in range(1, 50000):
+        expr = expr + Code(f'x{i}')
+
+    text = _render(expr)
+    assert text.startswith('(' * 49999 + 'x0 + x1) + x2)')
+    assert text.endswith(' + x49998) + x49999)')
+
+    b = CodeBuilder()
+    with ExitStack() as stack:
+        for i in range(5000):
+            stack.enter_context(b.IF(i))
+        b += sym.done()
+
+    lines = b.source_code().splitlines()
+    assert len(lines) == 5001
+    assert lines[-2] == '    ' * 4999 + 'if 4999:'
+    assert lines[-1] == '    ' * 5000 + 'done()'
+
+
+def test_interned_leaves():
+    assert sym.foo is sym.foo
+    assert sym.foo is not sym.bar
+    assert Val(1) is Val(1)
+    assert Val('1') is not Val(1)
+    assert Val(True) is not Val(1)
+    assert _render(Val(-0.0)) == '-0.0'
+    assert _render(Val(0.0)) == '0.0'
+
+    # Fragments use slots instead of a __dict__.
+    assert Code.__dictoffset__ == 0
+
+
+def test_streaming_output():
+    b = CodeBuilder()
+    for i in range(100):
+        with b.DEF(f'func{i}', ['x']):
+            b.RETURN(sym.x * i)
+    expected = b.source_code()
+
+    chunks = list(b.iter_source(chunk_size=100))
+    assert ''.join(chunks) == expected
+    assert len(chunks) > 10
+
+    out = io.StringIO()
+    b.write_to(out)
+    assert out.getvalue() == expected
+
+
+def test_stream_to_method():
+    def build(b):
+        b += sym.first << 1
+        with b.DEF('foo', ['bar']):
+            with b.global_section():
+                b += sym.second << 2
+            b.RETURN(sym.bar)
+        b += sym.third << 3
+
+    expected = CodeBuilder()
+    build(expected)
+
+    out = io.StringIO()
+    b = CodeBuilder()
+    b.stream_to(out)
+    build(b)
+    assert out.getvalue() == expected.source_code()
+
+    # Finished statements are not kept around.
+    assert b.source_code() == ''
+    with pytest.raises(ValueError):
+        b.compile()
+
+
+def test_render_cache():
+    guard = sym.isinstance(sym.node, sym.tuple) & (sym.len(sym.node) > 2)
+    b = CodeBuilder(render_cache_limit=50)
+    for i in range(3):
+        with b.IF(guard):
+            b += sym.handle(sym.node, 'x' * 50, i)
+
+    first = b.source_code()
+    assert first == b.source_code()
+    assert first.count('if (isinstance(node, tuple) & (len(node) > 2)):') == 3
+
+    # Only fragments that fit within the limit keep their text.
+    assert repr(sym.len(sym.node)) == 'len(node)'
+    assert guard._text == '(isinstance(node, tuple) & (len(node) > 2))'
+    assert sym.handle(sym.node, 'x' * 50, 0)._text is None
+
+
+def test_structure_key():
+    assert structure_key(sym.foo(1) + sym.bar) == structure_key(sym.foo(1) + sym.bar)
+    assert structure_key(sym.foo(1)) != structure_key(sym.foo(True))
+    assert structure_key(sym.foo(1)) != structure_key(sym.foo(1.0))
+    assert structure_key(sym.foo + 1) != structure_key(sym.foo - 1)
+    assert structure_key(sym.foo) != structure_key(Code('foo'))
+    assert structure_key(1) == structure_key(Val(1))
+
+
+def test_hash_cons_mode():
+    b = CodeBuilder(hash_cons=True)
+    b += sym.print(sym.text[sym.pos + 1])
+    b += sym.log(sym.text[sym.pos + 1], sym.pos + 1)
+
+    first, second = b._root
+    index = first._parts[2]
+    assert second._parts[2] is index
+    assert second._parts[4] is index._parts[2]
+    expected = 'print(text[(pos + 1)])\nlog(text[(pos + 1)], (pos + 1))\n'
+    assert b.source_code() == expected
+
+
+def test_hoist_method():
+    text, pos = sym.text, sym.pos
+    b = CodeBuilder()
+    with b.DEF('match', ['text', 'pos']):
+        with b.IF(b.hoist(text[pos], 'ch') == 'a'):
+            b.RETURN(b.hoist(text[pos + 1], 'ch'))
+        with b.ELIF(b.hoist(text[pos], 'ch') == 'b'):
+            b.RETURN(b.hoist(text[pos + 1], 'ch'))
+
+    expected = """
+        def match(text, pos):
+            ch1 = text[pos]
+            if (ch1 == 'a'):
+                ch2 = text[(pos + 1)]
+                return ch2
+            elif (ch1 == 'b'):
+                ch3 = text[(pos + 1)]
+                return ch3
+    """
+    assert b.source_code().strip() == dedent(expected).strip()
+
+    # A new temporary can't go between an if block and its elif.
+    with b.DEF('peek', ['text', 'pos']):
+        with b.IF(b.hoist(text[pos], 'ch') == 'a'):
+            b.RETURN(True)
+        condition = b.hoist(text[pos + 1], 'ch') == 'b'
+        with pytest.raises(ValueError), b.ELIF(condition):
+            b.RETURN(True)
+
+
+def _build_many_functions(b, count):
+    b.add_comment('Generated.')
+    b += sym.scale << 3
+    for i in range(count):
+        with b.IF(sym.scale > i):
+            b.add_newline()
+            b += sym.flags.append(i)
+        b.add_comment('Handles the other case.')
+        with b.ELSE():
+            b += sym.flags.append(-i)
+        with b.DEF(f'func{i}', ['x']):
+            with b.TRY():
+                b.RETURN(sym.x * i + sym.scale)
+            b.add_newline()
+            with b.EXCEPT(sym.TypeError):
+                b.RAISE(sym.ValueError(i))
+
+
+def test_compile_sharded():
+    b = CodeBuilder()
+    b += sym.flags << []
+    _build_many_functions(b, 20)
+
+    serial = b.compile()
+    with ThreadPoolExecutor(2) as executor:
+        sharded = b.compile_sharded(num_shards=4, executor=executor)
+
+    assert sharded.flags == serial.flags
+    for i in range(20):
+        expected, actual = getattr(serial, f'func{i}'), getattr(sharded, f'func{i}')
+        assert actual(10) == expected(10)
+        assert actual.__code__.co_firstlineno == expected.__code__.co_firstlineno
+
+    assert len(b._shard_source(4)) == 4
+    assert ''.join(b._shard_source(4)) == b.source_code()
+
+    # The __future__ imports apply to every shard.
+    b = CodeBuilder()
+    b += 'from __future__ import annotations'
+    b += sym.flags << []
+    _build_many_functions(b, 20)
+    with b.DEF('check', ['x: Undefined']):
+        b.RETURN(sym.x)
+    sharded = b.compile_sharded(num_shards=4)
+    assert sharded.check.__annotations__ == {'x': 'Undefined'}
+
+    # A shard never splits a def from its decorators.
+    b = CodeBuilder()
+    b += 'import functools'
+    for i in range(8):
+        b += '@functools.lru_cache()'
+        with b.DEF(f'func{i}', ['x']):
+            b.RETURN(sym.x + i)
+    for shard in b._shard_source(4):
+        compile(shard, '<shard>', 'exec')
+    sharded = b.compile_sharded(num_shards=4)
+    assert sharded.func7(1) == 8
+    assert sharded.func7.cache_info().misses == 1
+
+
+def test_compile_many():
+    builders = []
+    for i in range(3):
+        b = CodeBuilder()
+        b += sym.flags << [i]
+        _build_many_functions(b, i + 1)
+        builders.append(b)
+
+    modules = compile_many(builders, module_names=['a', 'b', 'c'])
+    assert [m.__name__ for m in modules] == ['a', 'b', 'c']
+    assert [m.flags for m in modules] == [[0, 0], [1, 0, 1], [2, 0, 1, 2]]
+    assert modules[2].func2(5) == 13
+
+
+def _build_nested_loops(b, depth):
+    total = b.var('total', 0)
+    with ExitStack() as stack:
+        for i in range(depth):
+            width = 2 if i == depth - 1 else 1
+            stack.enter_context(b.FOR(Code(f'i{i}'), sym.range(width)))
+        b += total << total + 1
+        with b.IF(total == sym.limit):
+            b.RETURN(total)
+    return total
+
+
+def test_outline_nested_blocks():
+    b = CodeBuilder()
+    with b.DEF('count', ['limit']):
+        b.RETURN(_build_nested_loops(b, 24))
+    with pytest.raises(SyntaxError):
+        b.compile()
+
+    b = CodeBuilder(outline=True)
+    with b.DEF('count', ['limit']):
+        b.RETURN(_build_nested_loops(b, 24))
+    assert '_outlined1' in b.source_code()
+    assert b.compile().count(-1) == 2
+    assert b.compile().count(1) == 1
+
+    # At the top level, outlined blocks update the globals directly.
+    b = CodeBuilder(outline=True)
+    total = b.var('total', 0)
+    with ExitStack() as stack:
+        for i in range(24):
+            stack.enter_context(b.FOR(Code(f'i{i}'), sym.range(1)))
+        b += total << total + i
+    assert b.compile().total1 == 23
+
+
+def test_outline_function_budget():
+    def build(b):
+        with b.DEF('classify', ['x']):
+            result = b.var('result', 'none')
+            for i in range(10):
+                with b.IF(sym.x == i):
+                    b += result << f'small{i}'
+                    b += sym.log.append(result)
+                    b += sym.log.append(i)
+                    b += sym.log.append(i * 2)
+            with b.IF(sym.x < 0):
+                b.RETURN('negative')
+            b.RETURN(result)
+
+    plain, outlined = CodeBuilder(), CodeBuilder(max_function_statements=12)
+    for b in [plain, outlined]:
+        b += sym.log << []
+        build(b)
+
+    assert '_outlined' not in plain.source_code()
+    assert '_outlined' in outlined.source_code()
+    expected, actual = plain.compile(), outlined.compile()
+    for x in [-1, 0, 5, 9, 20]:
+        assert actual.classify(x) == expected.classify(x)
+    assert actual.log == expected.log
+
+    # In a loop, a value can carry over from one iteration to the next, both in
+    # a name that the block binds and in one that the loop binds after it.
+    def build_loop(b):
+        with b.DEF('f', ['items']):
+            b += sym.out << []
+            with b.FOR(sym.k, sym.items):
+                with b.IF(sym.k >= 0):
+                    with b.IF(sym.k > 0):
+                        b += sym.out.append(sym.prev)
+                    b += sym.prev << sym.k
+                    b += sym.out.append(sym.k)
+                    b += sym.out.append(sym.k)
+                    b += sym.out.append(sym.k)
+                with b.IF(sym.k > 1):
+                    b += sym.out.append(sym.later)
+                    b += sym.out.append(sym.k)
+                    b += sym.out.append(sym.k)
+                    b += sym.out.append(sym.k)
+                b += sym.later << sym.k
+            b.RETURN(sym.out)
+
+    plain, outlined = CodeBuilder(), CodeBuilder(max_function_statements=2)
+    build_loop(plain)
+    build_loop(outlined)
+    assert '_outlined' in outlined.source_code()
+    expected = [0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 1, 2, 2, 2]
+    assert plain.compile().f([0, 1, 2]) == expected
+    assert outlined.compile().f([0, 1, 2]) == expected
+
+    # The call reads every input, so a block can't move if it reads a name that
+    # might not be bound yet.
+    def build_branches(b, always):
+        with b.DEF('f', ['x', 'z']):
+            b += sym.out << []
+            if always:
+                b += sym.y << 2
+            else:
+                with b.IF(sym.x):
+                    b += sym.y << 2
+            b += sym.out.append(1)
+            with b.IF_NOT(sym.z):
+                with b.IF(sym.x):
+                    b += sym.out.append(sym.y)
+                b += sym.out.append(3)
+                b += sym.out.append(4)
+            b.RETURN(sym.out)
+
+    for always in [False, True]:
+        plain, outlined = CodeBuilder(), CodeBuilder(max_function_statements=3)
+        build_branches(plain, always)
+        build_branches(outlined, always)
+        assert ('_outlined' in outlined.source_code()) == always
+        expected, actual = plain.compile(), outlined.compile()
+        for x in [False, True]:
+            assert actual.f(x, False) == expected.f(x, False)
+
+
+def test_fold_constants():
+    def build(b):
+        with b.DEF('f', ['x']):
+            b += sym.a << Val(3) * 4 + 1
+            b += sym.b << (-Val(2)) * sym.x
+            with b.IF(Val(1) > 2):
+                b.RETURN(Val('a') + 'b')
+            with b.ELIF(sym.x == 0):
+                b.RETURN((sym.a, sym.b))
+            with b.ELIF(Val(2) == 2):
+                b.RETURN(Val(2) ** 10_000 > 0)
+            with b.ELSE():
+                b.RETURN(None)
+
+        with b.DEF('g', ['x']):
+            with b.IF_NOT(sym.x == 1):
+                b.RETURN(sym.x)
+            with b.IF(Val(False)):
+                b.RETURN(1)
+
+    plain, folded = CodeBuilder(), CodeBuilder(fold_constants=True)
+    build(plain)
+    build(folded)
+    assert folded.source_code() == dedent("""\
+        def f(x):
+            a = 13
+            b = ((-2) * x)
+            if (x == 0):
+                return (a, b)
+            else:
+                return ((2 ** 10000) > 0)
+
+        def g(x):
+            if (x != 1):
+                return x
+
+    """)
+
+    expected, actual = plain.compile(), folded.compile()
+    for x in [0, 1, 2]:
+        assert actual.f(x) == expected.f(x)
+        assert actual.g(x) == expected.g(x)
+
+    ast_builder = CodeBuilder(use_ast=True, fold_constants=True)
+    build(ast_builder)
+    assert ast_builder.compile().f(0) == (13, 0)
+
+    # Dead branches still decide whether a function is a generator, and which
+    # of its names are locals.
+    b = CodeBuilder(fold_constants=True)
+    with b.DEF('empty', []), b.IF(Val(False)):
+        b.YIELD(1)
+    with b.DEF('shadow', []):
+        with b.IF(Val(True)):
+            b.RETURN(sym.total)
+        with b.ELSE():
+            b += sym.total << 0
+    with b.DEF('declare', []):
+        with b.IF(Val(False)):
+            b += 'global total'
+            b += sym.total << 0
+        b += sym.total << 5
+    b += sym.total << 1
+    module = b.compile()
+    assert list(module.empty()) == []
+    with pytest.raises(UnboundLocalError):
+        module.shadow()
+    module.declare()
+    assert module.total == 5
+
+
+def test_minimal_parens():
+    a, b, c = sym.a, sym.b, sym.c
+    examples = [
+        (a + b * c, 'a + b * c'),
+        ((a + b) * c, '(a + b) * c'),
+        (a - (b - c), 'a - (b - c)'),
+        ((a - b) - c, 'a - b - c'),
+        (a**b**c, 'a ** b ** c'),
+        ((a**b) ** c, '(a ** b) ** c'),
+        (-(a**b), '-a ** b'),
+        ((-a) ** b, '(-a) ** b'),
+        (Val(-2) ** a, '(-2) ** a'),
+        (a**-b, 'a ** -b'),
+        ((a < b) == c, '(a < b) == c'),
+        (_binop(_binop(a, 'and', b), 'and', c), '(a and b) and c'),
+        (_binop(a, 'or', _binop(b, 'and', c)), 'a or b and c'),
+        ((a + b).d(c - 1)[c], '(a + b).d(c - 1)[c]'),
+        (Val(1).real, '(1).real'),
+        (Code('f(', a + b, ')'), 'f((a + b))'),
+    ]
+
+    builder = CodeBuilder()
+    for expr, expected in examples:
+        builder += expr
+    with builder.IF_NOT(a == b):
+        builder.RETURN((a + b, -c))
+
+    expected = [text for _, text in examples]
+    expected += ['if not a == b:', '    return (a + b, -c)']
+    assert builder.source_code(minimal_parens=True) == '\n'.join(expected) + '\n'
+    assert builder.source_code().startswith('(a + (b * c))\n')
+
+    builder = CodeBuilder()
+    builder += sym.x << (Val(1) + 2) * 3
+    module = builder.compile(source_var='source')
+    assert module.x == 9
+    assert module.source == 'x = (1 + 2) * 3\n'
+
+
+def _random_expression(rng, leaves, depth, operators):
+    if depth == 0 or rng.random() < 0.2:
+        return Val(rng.choice(leaves))
+
+    operand = _random_expression(rng, leaves, depth - 1, operators)
+    choice = rng.randrange(len(operators) + 2)
+    if choice == 0:
+        return -operand
+    if choice == 1:
+        return ~operand
+
+    other = _random_expression(rng, leaves, depth - 1, operators)
+    if rng.random() < 0.5:
+        operand, other = other, operand
+    return _binop(operand, operators[choice - 2], other)
+
+
+def test_minimal_parens_round_trip():
+    # With minimal parentheses, the source should parse to the same tree.
+    operators = ['+', '-', '*', '@', '/', '//', '%', '**', '<<', '>>', '&', '|', '^']
+    operators += ['==', '!=', '<', '<=', '>', '>=', 'in', 'is', 'and', 'or']
+    operators += ['not in', 'is not']
+    leaves = [sym.a, sym.b, sym.c, 2.5, 'x']
+    rng = random.Random(42)
+    for _ in range(300):
+        expr = _random_expression(rng, leaves, 6, operators)
+        b = CodeBuilder()
+        b += sym.result << expr
+        b += sym.f(expr.attr, expr[expr])
+        with b.IF_NOT(expr):
+            b.RETURN((expr, [expr]))
+
+        full = ast.dump(ast.parse(b.source_code()))
+        assert ast.dump(ast.parse(b.source_code(minimal_parens=True))) == full
+
+
+def test_minimal_parens_semantics():
+    operators = ['+', '-', '*', '//', '%', '&', '|', '^']
+    operators += ['==', '!=', '<', '>', 'and', 'or']
+    leaves = [sym.a, sym.b, sym.c, 0, 3, -2, True]
+    names = {'a': 5, 'b': -7, 'c': 0}
+    rng = random.Random(7)
+    for _ in range(300):
+        expr = _random_expression(rng, leaves, 5, operators)
+        results = []
+        for text in [repr(expr), CodeBuilder().append(expr).source_code(True)]:
+            try:
+                results.append(eval(text, dict(names)))
+            except ArithmeticError as exc:
+                results.append(type(exc))
+        assert results[0] == results[1]
+
+
+def test_build_stats():
+    reports = []
+    b = CodeBuilder(stats=reports.append)
+    with b.DEF('f', ['x']):
+        with b.IF(sym.x > 0), b.FOR(sym.i, sym.range(sym.x)):
+            b += sym.print(sym.i + 1)
+        b.RETURN(sym.x * 2)
+
+    module = b.compile()
+    assert module.f(3) == 6
+    assert reports == [b.stats]
+
+    stats = b.stats.as_dict()
+    assert set(stats['phases']) == {'build', 'render', 'compile', 'exec'}
+    for phase in stats['phases'].values():
+        assert phase['wall_time'] >= 0
+        assert isinstance(phase['allocated_blocks'], int)
+
+    assert stats['num_blocks'] == 3
+    assert stats['peak_num_blocks'] == 4
+    assert stats['max_depth'] == 4
+    assert stats['num_lines'] == 6
+    assert stats['num_bytes'] == len(b.source_code(minimal_parens=True))
+    assert stats['num_nodes'] > 10
+
+    b.stats.reset()
+    assert b.stats.phases == {}
+    b.source_code()
+    assert set(b.stats.phases) == {'build', 'render'}
+
+    assert CodeBuilder().stats is None
+
+
+def test_profile_counters():
+    def build(b):
+        with b.DEF('sign', ['x']):
+            with b.IF(sym.x > 0):
+                b.RETURN(1)
+            with b.ELIF(sym.x < 0):
+                b.RETURN(-1)
+            with b.ELSE():
+                b.RETURN(0)
+
+        with b.CLASS('Totals'), b.DEF('total', ['self', 'items']):
+            result = b.var('result', 0)
+            with b.FOR(sym.item, sym.items):
+                b += result << result + sym.sign(sym.item)
+            b.RETURN(result)
+
+    plain = CodeBuilder()
+    build(plain)
+    assert '_profile' not in plain.source_code()
+
+    b = CodeBuilder(profile_branches=True)
+    build(b)
+    module = b.compile()
+    assert module.Totals().total([4, -2, 3, 0]) == 1
+
+    profile = read_profile(module)
+    counts = {label: entry['count'] for label, entry in profile.items()}
+    assert counts == {
+        'Totals.total': 1,
+        'Totals.total:for#1': 4,
+        'sign': 4,
+        'sign:if#1': 2,
+        'sign:elif#2': 1,
+        'sign:else#3': 1,
+    }
+    assert profile['sign']['time'] > 0
+    assert profile['sign:if#1']['time'] is None
+
+    reset_profile(module)
+    assert read_profile(module) == {}
+
+    b = CodeBuilder(profile=True)
+    build(b)
+    module = b.compile()
+    module.sign(5)
+    assert list(read_profile(module)) == ['sign']
+
+
+def test_profile_guided_reordering(tmp_path):
+    def build(b):
+        with b.DEF('kind', ['x']):
+            for i, name in enumerate(['a', 'b', 'c', 'd']):
+                with (b.ELIF if i else b.IF)(sym.x == name, reorderable=True):
+                    b.RETURN(i)
+            with b.ELIF(sym.x.startswith('e')):
+                b.RETURN('e')
+            with b.ELIF(sym.x == 'f', reorderable=True):
+                b.RETURN('f')
+            with b.ELSE():
+                b.RETURN(None)
+
+    b = CodeBuilder(profile_branches=True)
+    build(b)
+    module = b.compile()
+    inputs = ['a', 'c', 'c', 'd', 'd', 'd', 'e', 'f', 'f', 'z']
+    for x in inputs:
+        module.kind(x)
+
+    path = tmp_path / 'profile.json'
+    save_profile(module, path)
+    assert load_profile(path)['kind:elif#4'] == 3
+
+    tuned = CodeBuilder(branch_profile=path)
+    build(tuned)
+    assert tuned.source_code() == dedent("""\
+        def kind(x):
+            if (x == 'd'):
+                return 3
+            elif (x == 'c'):
+                return 2
+            elif (x == 'a'):
+                return 0
+            elif (x == 'b'):
+                return 1
+            elif x.startswith('e'):
+                return 'e'
+            elif (x == 'f'):
+                return 'f'
+            else:
+                return None
+
+    """)
+
+    plain = CodeBuilder()
+    build(plain)
+    expected, actual = plain.compile(), tuned.compile()
+    for x in inputs:
+        assert actual.kind(x) == expected.kind(x)
+
+    path.write_text('{"counts": {}}')
+    with pytest.raises(ValueError):
+        load_profile(path)
+
+
+def test_lazy_compile():
+    b = CodeBuilder()
+    b += sym.scale << 10
+    for i in range(3):
+        with b.DEF(f'f{i}', ['x']):
+            b.RETURN(sym.x * sym.scale + i)
+    b += sym.first << sym.f0(1)
+    with b.DEF('fail', []):
+        b += '1 / 0'
+
+    module = b.compile(lazy=True)
+    eager = b.compile()
+    assert module.first == 10
+    stub = module.f2
+    assert stub.__name__ == 'f2'
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(stub, range(100)))
+    assert results == [x * 10 + 2 for x in range(100)]
+    assert module.f2 is not stub
+    assert module.f2.__code__.co_firstlineno == eager.f2.__code__.co_firstlineno
+    assert stub(5) == 52
+
+    with pytest.raises(ZeroDivisionError) as info:
+        module.fail()
+    traceback = info.value.__traceback__
+    while traceback.tb_next is not None:
+        traceback = traceback.tb_next
+    assert traceback.tb_lineno == eager.fail.__code__.co_firstlineno + 1
+
+    # The functions get the module's __future__ imports.
+    b = CodeBuilder()
+    b += 'from __future__ import annotations'
+    with b.DEF('check', ['x: Undefined']):
+        b.RETURN(sym.x)
+    module = b.compile(lazy=True)
+    assert module.check(1) == 1
+    assert module.check.__annotations__ == {'x': 'Undefined'}
+
+
+def test_write_module(tmp_path, monkeypatch):
+    b = CodeBuilder()
+    b += sym.scale << 10
+    with b.DEF('double', ['x']):
+        b.RETURN(sym.x * 2)
+    with b.CLASS('Scaler'), b.DEF('apply', ['self', 'x']):
+        b.RETURN(sym.double(sym.x) * sym.scale)
+    b += sym.result << sym.Scaler().apply(3)
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+    b.write_module(tmp_path / 'aot_single.py', docstring='Generated.')
+    b.write_module(tmp_path / 'aot_split', split=True, check_source=False)
+    assert sorted(os.listdir(tmp_path / 'aot_split')) == [
+        '_Scaler.py',
+        '__init__.py',
+        '__pycache__',
+        '_double.py',
+    ]
+
+    # Break the split sources, to show that imports use the unchecked .pyc files.
+    for name in ['__init__.py', '_double.py', '_Scaler.py']:
+        (tmp_path / 'aot_split' / name).write_text('raise ImportError\n')
+
+    try:
+        single = importlib.import_module('aot_single')
+        split = importlib.import_module('aot_split')
+        assert single.__doc__ == 'Generated.'
+        assert single.result == split.result == 60
+        assert split.Scaler().apply(1) == 20
+        assert split.double.__code__.co_filename.endswith('_double.py')
+    finally:
+        for name in ['aot_single', 'aot_split']:
+            sys.modules.pop(name, None)
+
+    # The __future__ imports stay first, and apply to each file.
+    b = CodeBuilder()
+    b += 'from __future__ import annotations'
+    with b.DEF('check', ['x: Undefined']):
+        b.RETURN(sym.x)
+    b.write_module(tmp_path / 'aot_future', docstring='Generated.', split=True)
+    try:
+        future = importlib.import_module('aot_future')
+        assert future.__doc__ == 'Generated.'
+        assert future.check.__annotations__ == {'x': 'Undefined'}
+    finally:
+        sys.modules.pop('aot_future', None)
+
+
+def test_hoist_loop_invariants():
+    def build(b):
+        with b.DEF('split_words', ['text', 'out']):
+            word = b.var('word', '')
+            with b.FOR(sym.char, sym.text):
+                with b.IF(sym.str.isspace(sym.char)):
+                    b += sym.out.append(word)
+                    b += word << ''
+                with b.ELSE():
+                    b += word << word + sym.str(sym.char)
+            b += sym.out.append(word)
+            b.RETURN(sym.len(sym.out))
+
+        with b.DEF('count', ['items']):
+            counts = b.var('counts', {})
+            with b.FOR(sym.item, sym.items):
+                b += counts[sym.item] << counts.get(sym.item, 0) + 1
+            b.RETURN(counts)
+
+    b = CodeBuilder(hoist_loop_invariants=True)
+    build(b)
+    assert b.source_code() == dedent("""\
+        def split_words(text, out):
+            word1 = ''
+            isspace1 = str.isspace
+            for char in text:
+                if isspace1(char):
+                    out.append(word1)
+                    word1 = ''
+                else:
+                    word1 = (word1 + str(char))
+            out.append(word1)
+            return len(out)
+
+        def count(items):
+            counts1 = {}
+            try:
+                get1 = counts1.get
+            except Exception:
+                get1 = lambda *args1, **kwargs1: counts1.get(*args1, **kwargs1)
+            for item in items:
+                counts1[item] = (get1(item, 0) + 1)
+            return counts1
+
+    """)
+
+    plain = CodeBuilder()
+    build(plain)
+    expected, actual = plain.compile(), b.compile()
+    words = []
+    assert actual.split_words('a bc d', words) == 3
+    assert words == ['a', 'bc', 'd']
+    assert actual.count('abca') == expected.count('abca') == {'a': 2, 'b': 1, 'c': 1}
+
+    # Globals that other code rebinds stay in the loop, even when the code
+    # comes after the function. So do names that the loop only reads in a
+    # branch, since the loop may not run at all.
+    b = CodeBuilder(hoist_loop_invariants=True)
+    b += sym.depth << 0
+    with b.DEF('track', ['n']):
+        seen = b.var('seen', [])
+        with b.FOR(sym.i, sym.range(sym.n)):
+            b += sym.enter()
+            b += seen.append(sym.depth)
+        b.RETURN(seen)
+
+    with b.DEF('enter', []):
+        b += Code('global depth')
+        b += sym.depth << sym.depth + 1
+
+    with b.DEF('report', ['n']):
+        with b.FOR(sym.i, sym.range(sym.n)), b.IF(sym.i > 5):
+            b += sym.missing(sym.i)
+        b.RETURN(sym.n)
+
+    source = b.source_code()
+    assert 'depth1' not in source and 'missing1' not in source
+    module = b.compile()
+    assert module.track(3) == [1, 2, 3]
+    assert module.report(0) == 0
+
+    # A call in the loop can rebind self.items, so self.items.append stays. A
+    # lookup that fails only fails once the loop uses it.
+    b = CodeBuilder(hoist_loop_invariants=True)
+    with b.CLASS('Batcher'):
+        with b.DEF('__init__', ['self']):
+            b += sym.self.items << []
+            b += sym.self.batches << []
+        with b.DEF('flush', ['self']):
+            b += sym.self.batches.append(sym.self.items)
+            b += sym.self.items << []
+        with b.DEF('run', ['self', 'values']):
+            with b.FOR(sym.value, sym.values):
+                b += sym.self.items.append(sym.value)
+                b += sym.self.flush()
+            b.RETURN(sym.self.batches)
+
+    with b.DEF('fill', ['values', 'out']):
+        with b.FOR(sym.value, sym.values):
+            b += sym.out.append(sym.value)
+            b += sym.undefined(sym.value)
+            b += sym.last << sym.marker
+        b.RETURN(sym.out)
+
+    source = b.source_code()
+    assert 'self.items.append(value)' in source
+    assert 'marker1' not in source
+    module = b.compile()
+    assert module.Batcher().run([1, 2, 3]) == [[1], [2], [3]]
+    assert module.fill([], None) is None
+    with pytest.raises(AttributeError):
+        module.fill([1], None)
+    with pytest.raises(NameError):
+        module.fill([1], [])
+
+
+def test_scoped_names():
+    b = CodeBuilder(scoped_names=True)
+    limit = b.var('limit', 10)
+    for name in ['first', 'second']:
+        with b.DEF(name, ['text']):
+            pos = b.var('pos', 0)
+            b.release(pos)
+            end = b.var('pos', sym.len(sym.text))
+            b.RETURN(sym.min(end, limit))
+            with pytest.raises(ValueError):
+                b.release(limit)
+
+    with b.DEF('outer', ['x']):
+        pos = b.var('pos', sym.x)
+        with b.DEF('inner', []):
+            b.RETURN(b.var('pos', pos + 1))
+        b.RETURN(sym.inner())
+    b += sym.pos << b.var('pos', 0)
+
+    assert b.source_code() == dedent("""\
+        limit1 = 10
+        def first(text):
+            pos1 = 0
+            pos1 = len(text)
+            return min(pos1, limit1)
+
+        def second(text):
+            pos1 = 0
+            pos1 = len(text)
+            return min(pos1, limit1)
+
+        def outer(x):
+            pos1 = x
+            def inner():
+                pos2 = (pos1 + 1)
+                return pos2
+
+            return inner()
+
+        pos3 = 0
+        pos = pos3
+    """)
+    module = b.compile()
+    assert module.second('abc') == 3
+    assert module.outer(1) == 2
+
+
+def test_eliminate_dead_code():
+    def build(b):
+        with b.DEF('check', ['x', 'quiet']):
+            unused = b.var('unused', sym.x + 1)
+            logged = b.var('logged', sym.print(sym.x))
+            total = b.var('total', sym.x * 2)
+            b += unused << total
+            b.var('ignored', sym.input())
+            with b.IF(sym.x > 10):
+                b.RETURN('big')
+                b += sym.print('unreachable')
+            with b.ELIF(sym.x > 5):
+                pass
+            with b.ELSE():
+                b.add_comment('Nothing to do.')
+            with b.IF(sym.x < 0):
+                b.RAISE(sym.ValueError(sym.x))
+            with b.ELIF(sym.quiet):
+                pass
+            with b.IF(sym.x.is_integer()):
+                pass
+            b.RETURN(logged)
+
+        # Subscripts can raise, so the value stays as an expression statement.
+        with b.DEF('peek', ['text', 'pos']):
+            with b.TRY():
+                b.var('ch', sym.text[sym.pos])
+            with b.EXCEPT(sym.IndexError):
+                b.RETURN(False)
+            with b.TRY(), b.IF(sym.text[sym.pos] == '!'):
+                pass
+            with b.EXCEPT(sym.IndexError):
+                b.RETURN(False)
+            b.RETURN(True)
+
+    b = CodeBuilder(eliminate_dead_code=True)
+    build(b)
+    assert b.source_code() == dedent("""\
+        def check(x, quiet):
+            (x + 1)
+            logged1 = print(x)
+            (x * 2)
+            input()
+            if (x > 10):
+                return 'big'
+            elif (x > 5):
+                pass
+            if (x < 0):
+                raise ValueError(x)
+            if x.is_integer():
+                pass
+            return logged1
+
+        def peek(text, pos):
+            try:
+                text[pos]
+            except IndexError:
+                return False
+            try:
+                if (text[pos] == '!'):
+                    pass
+            except IndexError:
+                return False
+            return True
+
+    """)
+
+    plain = CodeBuilder()
+    build(plain)
+    assert 'unreachable' in plain.source_code()
+    assert b.compile().peek('a', 5) is False
+    assert b.compile().peek('a', 0) is True
+
+    # Unreachable code still decides whether a function is a generator.
+    b = CodeBuilder(eliminate_dead_code=True)
+    with b.DEF('empty', []):
+        b.RETURN()
+        b.YIELD()
+    assert list(b.compile().empty()) == []
+
+
+def test_peephole():
+    def build(b):
+        with b.DEF('render', ['out', 'pos', 'verbose']):
+            b += sym.out.append('<')
+            b += sym.out.append('b')
+            b += sym.out.append(sym.pos)
+            b += sym.out.append('>')
+            b += sym.out.append('!')
+            b += sym.pos << sym.pos + 1
+            b += sym.pos << sym.pos + 2
+            b += sym.pos << sym.pos - 5
+            with b.IF(sym.verbose, fuse=True):
+                b += sym.out.append('[')
+            with b.IF(sym.verbose, fuse=True):
+                b += sym.out.append(']')
+            with b.IF(sym.verbose):
+                b += sym.out.append('.')
+            b.RETURN(sym.pos)
+
+    b = CodeBuilder(peephole=[merge_literal_appends, combine_increments])
+    build(b)
+    assert b.source_code() == dedent("""\
+        def render(out, pos, verbose):
+            out.extend(['<', 'b'])
+            out.append(pos)
+            out.extend(['>', '!'])
+            pos = (pos - 2)
+            if verbose:
+                out.extend(['[', ']'])
+            if verbose:
+                out.append('.')
+            return pos
+
+    """)
+
+    plain = CodeBuilder()
+    build(plain)
+    expected, actual = [], []
+    assert plain.compile().render(expected, 3, True) == 1
+    assert b.compile().render(actual, 3, True) == 1
+    assert actual == expected
+
+    # By default, increments stay apart, since they might not be ints.
+    b = CodeBuilder(peephole=True)
+    build(b)
+    assert 'pos = (pos + 2)' in b.source_code()
+    big = 2.0**53
+    assert b.compile().render([], big, False) == plain.compile().render([], big, False)
+
+    def drop_passes(first, second):
+        return [first] if repr(second) == 'pass' else None
+
+    b = CodeBuilder(peephole=[drop_passes])
+    b += sym.x << 1
+    b += Code('pass')
+    assert b.source_code() == 'x = 1\n'
+
+
+def test_call_sites():
+    b = CodeBuilder(record_call_sites=True)
+    first = sys._getframe().f_lineno
+    with b.DEF('f', ['x']):
+        b += sym.y << sym.x * 2
+        with b.IF(sym.y > 10):
+            b.RAISE(sym.ValueError(sym.y))
+        b.RETURN(sym.y)
+
+    assert b.line_map() == {i: (__file__, first + i) for i in range(1, 6)}
+
+    module = b.compile()
+    with pytest.raises(ValueError) as info:
+        module.f(6)
+    line = info.traceback[-1].lineno + 1
+    assert b.attribute_samples([('<code>', line), ('<other>', line)]) == {
+        (__file__, first + 4): 1
+    }
+
+    profile = cProfile.Profile()
+    profile.runcall(module.f, 1)
+    stats = pstats.Stats(profile)
+    assert list(b.attribute_samples(stats)) == [(__file__, first + 1)]
+
+
+def test_fork_and_merge():
+    def build_rule(b, i):
+        with b.DEF(f'rule{i}', ['text']):
+            with b.global_section():
+                table = b.var('table', {f'key{i}': i})
+            result = b.var('result', table.get(sym.text))
+            b.RETURN(result)
+
+    b = CodeBuilder(scoped_names=True)
+    b += sym.first << 1
+    forks = [b.fork() for _ in range(3)]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(build_rule, reversed(forks), [2, 1, 0]))
+
+    # A fork can also make a round trip through pickle, as with a process pool.
+    forks[1] = pickle.loads(pickle.dumps(forks[1]))
+    b.merge(*forks)
+    b += sym.last << 2
+    assert b.source_code() == dedent("""\
+        first = 1
+        table_1_1 = {'key0': 0}
+        def rule0(text):
+            result_1_1 = table_1_1.get(text)
+            return result_1_1
+
+        table_2_1 = {'key1': 1}
+        def rule1(text):
+            result_2_1 = table_2_1.get(text)
+            return result_2_1
+
+        table_3_1 = {'key2': 2}
+        def rule2(text):
+            result_3_1 = table_3_1.get(text)
+            return result_3_1
+
+        last = 2
+    """)
+    assert b.compile().rule2('key2') == 2
+
+    with pytest.raises(ValueError):
+        b.merge(forks[0])
+
+    # A fork's hoisted globals are undone when the parent rebinds them, even
+    # after a round trip through pickle.
+    b = CodeBuilder(hoist_loop_invariants=True)
+    b += sym.scale << Code('lambda x: x * 2')
+    fork = b.fork()
+    with fork.DEF('track', ['items']):
+        seen = fork.var('seen', [])
+        with fork.FOR(sym.item, sym.items):
+            fork += seen.append(sym.scale(sym.item))
+            fork += sym.switch()
+        fork.RETURN(seen)
+    b.merge(pickle.loads(pickle.dumps(fork)))
+    with b.DEF('switch', []):
+        b += Code('global scale')
+        b += sym.scale << Code('lambda x: x * 3')
+    assert b.compile().track([1, 2]) == [2, 6]
+
+
+def test_compile_template():
+    b = CodeBuilder()
+    b += sym.prefix << 'token:'
+    with b.DEF('match', ['text', 'pos']):
+        with b.IF(sym.text.startswith(sym.literal, sym.pos)):
+            b.RETURN((sym.prefix + sym.token, sym.pos + sym.len(sym.literal)))
+        with b.IF(sym.pos < sym.len(sym.text)):
+            b.RETURN(sym.match(sym.text, sym.pos + 1))
+        b += '1 / 0'
+
+    make_match = b.compile_template('match', ['literal', 'token'])
+    matchers = [make_match(literal=f'x{i}', token=str(i)) for i in range(100)]
+    assert matchers[7]('ab x7', 0) == ('token:7', 5)
+    assert matchers[7].__name__ == 'match'
+    assert make_match.__name__ == 'match_template'
+    assert all(m.__code__ is matchers[0].__code__ for m in matchers)
+
+    # Line numbers match the module's source code.
+    with pytest.raises(ZeroDivisionError) as info:
+        matchers[3]('', 0)
+    lines = b.source_code().split('\n')
+    assert info.traceback[-1].lineno == lines.index('    1 / 0')
+
+    with pytest.raises(ValueError):
+        b.compile_template('missing', [])
+
+    # The function can start on the first line.
+    b = CodeBuilder()
+    with b.DEF('fail', []):
+        b += '1 / 0'
+    with pytest.raises(ZeroDivisionError) as info:
+        b.compile_template('fail', [])()()
+    assert info.traceback[-1].lineno == 1
+
+    # The function gets the module's __future__ imports.
+    b = CodeBuilder()
+    b += 'from __future__ import annotations'
+    with b.DEF('check', ['x: Undefined']):
+        b.RETURN(sym.x)
+    check = b.compile_template('check', [])()
+    assert check.__annotations__ == {'x': 'Undefined'}